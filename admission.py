@@ -0,0 +1,77 @@
+"""
+Admission control for the generation endpoints, shared by every gunicorn worker.
+
+Workers are separate processes, so slots are lock files under LOCK_DIR held with
+flock(); the kernel releases them if a worker dies mid-request. A request first
+takes a ticket (GENERATE_CONCURRENCY running + GENERATE_QUEUE waiting). Without a
+ticket it is refused at once with 429. With one it waits up to GENERATE_WAIT
+seconds for a run slot, then gives up with 503. Both carry Retry-After.
+
+Waiting requests hold a worker too, so tickets are capped at WEB_CONCURRENCY minus
+READ_RESERVED: those workers stay free for page loads and cheap reads such as
+/api/get_details, however many files are being generated.
+"""
+import fcntl
+import os
+import time
+from contextlib import contextmanager
+
+LOCK_DIR = os.getenv('ADMISSION_LOCK_DIR', os.path.join(os.path.dirname(__file__), 'data', 'locks'))
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', '4')) # gunicorn -w in run_app.sh
+READ_RESERVED = int(os.getenv('READ_RESERVED', '1'))
+GENERATE_CONCURRENCY = int(os.getenv('GENERATE_CONCURRENCY', str(max(1, WEB_CONCURRENCY // 2))))
+GENERATE_QUEUE = int(os.getenv('GENERATE_QUEUE', str(max(0, WEB_CONCURRENCY - READ_RESERVED - GENERATE_CONCURRENCY))))
+GENERATE_WAIT = float(os.getenv('GENERATE_WAIT', '10'))
+RETRY_AFTER = int(os.getenv('RETRY_AFTER', '5'))
+POLL_INTERVAL = 0.05
+
+class Overloaded(Exception):
+    """Raised when a request is not admitted. status is 429 (queue full) or 503 (waited too long)."""
+    def __init__(self, status, retry_after, message):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+def _try_lock(name, size):
+    """Returns: an open fd holding one of name's `size` slots, or None if all are taken."""
+    if not os.path.exists(LOCK_DIR):
+        os.makedirs(LOCK_DIR, exist_ok=True)
+    for i in range(size):
+        fd = os.open(os.path.join(LOCK_DIR, f"{name}.{i}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            os.close(fd)
+    return None
+
+def _unlock(fd):
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+@contextmanager
+def admit(name='generate', concurrency=None, queue=None, wait=None):
+    """
+    Runs the enclosed block once one of `concurrency` slots is free, across all workers.
+    Raises: Overloaded (429) if `queue` requests are already waiting,
+            Overloaded (503) if no slot frees up within `wait` seconds.
+    """
+    concurrency = concurrency or GENERATE_CONCURRENCY
+    queue = GENERATE_QUEUE if queue is None else queue
+    wait = GENERATE_WAIT if wait is None else wait
+
+    ticket = _try_lock(f"{name}-ticket", concurrency + queue)
+    if ticket is None:
+        raise Overloaded(429, RETRY_AFTER, "Server is busy generating files, please retry shortly.")
+    try:
+        deadline = time.monotonic() + wait
+        while (slot := _try_lock(f"{name}-run", concurrency)) is None:
+            if time.monotonic() >= deadline:
+                raise Overloaded(503, RETRY_AFTER, "Timed out waiting for a free generation slot, please retry shortly.")
+            time.sleep(POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            _unlock(slot)
+    finally:
+        _unlock(ticket)
@@ -1,7 +1,27 @@
-from flask import Flask, render_template, request, redirect, url_for, send_file, flash
-from database import get_food, add_food, get_db_connection
-from excel_utils import generate_excel, process_bulk_upload_excel, extract_names_from_excel
+from flask import Flask, render_template, request, redirect, url_for, send_file, flash, session, Response, g
+from markupsafe import Markup
+from database import (
+    get_food, add_food, get_db_connection, upsert_foods, init_db, save_menu, get_menu, list_menus, delete_menu,
+    search_foods, get_changes, set_property, reset_property, get_property, list_properties, use_property,
+    create_property
+)
+from excel_utils import (
+    generate_excel, preview_rows, process_bulk_upload_excel, write_rejection_report, extract_names_batch, get_saved_menu_file,
+    allergen_summary, write_allergen_summary, export_catalogue_csv, export_catalogue_xlsx, OUTPUT_DIR, EXTRACT_RANGE,
+    ArchiveTooLarge, remove_rendered_file, canonical_allergen
+)
+from scheduler import parse_schedule
+from admission import admit, Overloaded
+import memwatch
+from uploads import (
+    create_upload, get_upload, append_chunk, finalize_upload, discard_upload, UploadError, UPLOAD_CHUNK_SIZE
+)
+from tracing import TRACE_HEADER, span, record_span, set_trace_id, reset_trace_id
+import hmac
 import os
+import time
+import uuid
+from datetime import datetime
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -16,6 +36,95 @@ VALID_ALLERGENS = [
     'Molluscs', 'Mustard', 'Nuts', 'Peanuts', 'Sesame', 'Soy', 'Sulphite'
 ]
 
+@app.before_request
+def select_property():
+    """
+    Routes this request to a property's database. API clients send an X-Property header;
+    the web UI picks it with ?property= and keeps it in the session.
+    """
+    key = request.headers.get('X-Property')
+    if key is None and request.values.get('property') is not None:
+        key = request.values.get('property')
+        session['property'] = key
+    if key is None:
+        key = session.get('property')
+
+    try:
+        g.property_token = set_property(key)
+    except ValueError as e:
+        session.pop('property', None)
+        return {'error': str(e)}, 400
+
+@app.teardown_request
+def clear_property(exc):
+    token = g.pop('property_token', None)
+    if token is not None:
+        reset_property(token)
+
+@app.before_request
+def start_trace():
+    """Joins the caller's trace when it sends an X-Trace-Id header."""
+    trace_id = request.headers.get(TRACE_HEADER)
+    if trace_id:
+        g.trace_id = trace_id[:64]
+        g.trace_token = set_trace_id(g.trace_id)
+        g.trace_start = (time.time(), time.perf_counter())
+
+@app.after_request
+def finish_trace(response):
+    if 'trace_start' in g:
+        start, perf_start = g.trace_start
+        record_span(f"{request.method} {request.url_rule.rule if request.url_rule else request.path}",
+                    start, time.perf_counter() - perf_start, status=response.status_code)
+        response.headers[TRACE_HEADER] = g.trace_id
+    return response
+
+@app.teardown_request
+def end_trace(exc):
+    token = g.pop('trace_token', None)
+    if token is not None:
+        reset_trace_id(token)
+
+@app.before_request
+def start_memory_watch():
+    g.rss_before = memwatch.begin()
+
+@app.teardown_request
+def end_memory_watch(exc):
+    if 'rss_before' in g:
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        memwatch.end(f"{request.method} {rule}", g.pop('rss_before'))
+
+def _is_admin_request():
+    """
+    Admin endpoints need the ADMIN_TOKEN header; without a configured token they are closed.
+    The peer address proves nothing: the tunnel connects from localhost too.
+    """
+    token = os.getenv('ADMIN_TOKEN')
+    return bool(token) and hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token)
+
+@app.errorhandler(UploadError)
+def upload_error(e):
+    if request.path.startswith('/api/'):
+        return {'error': str(e), 'offset': e.offset}, e.status
+    flash(f"Upload failed: {e}", 'error')
+    return redirect(url_for('index', tab='upload'))
+
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    """Generation is at capacity: fail fast and tell the client when to come back."""
+    headers = {'Retry-After': str(e.retry_after)}
+    if request.path.startswith('/api/'):
+        return {'error': str(e), 'retry_after': e.retry_after}, e.status, headers
+    flash(str(e), 'warning')
+    response = redirect(url_for('index'))
+    response.headers.update(headers)
+    return response
+
+@app.context_processor
+def inject_property():
+    return {'current_property': get_property(), 'properties': list_properties()}
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
@@ -56,7 +165,7 @@ def index():
         
         return render_template('verify.html', items=items_data, valid_allergens=VALID_ALLERGENS)
         
-    return render_template('index.html')
+    return render_template('index.html', menus=list_menus())
 
 @app.route('/save_missing', methods=['POST'])
 def save_missing():
@@ -88,35 +197,88 @@ def save_missing():
 
     return render_template('verify.html', items=items_data, valid_allergens=VALID_ALLERGENS)
 
+def _verify_form_items():
+    """
+    Reads the verify form's edited items.
+    Returns: (food_names, custom_data) for generate_excel / preview_rows.
+    """
+    item_count = int(request.form.get('item_count', 0))
+    food_names = []
+    custom_data = {}
+    
+    for i in range(item_count):
+        name = request.form.get(f'name_{i}')
+        calories = request.form.get(f'calories_{i}')
+        # Allergens are now checkboxes, so getlist
+        allergens_list = request.form.getlist(f'allergens_{i}')
+        
+        if name:
+            food_names.append(name)
+            custom_data[name] = {
+                'calories': int(calories) if calories else 0,
+                'allergens': allergens_list # List of strings
+            }
+    return food_names, custom_data
+
+@app.route('/verify_preview', methods=['POST'])
+def verify_preview():
+    # Same rows as /verify_generate, computed in memory (no workbook, no admission slot)
+    try:
+        food_names, custom_data = _verify_form_items()
+        return {'status': 'success', **preview_rows(food_names, custom_data=custom_data)}
+    except Exception as e:
+        print(f"Preview Error: {e}")
+        return {'error': str(e)}, 400
+
 @app.route('/verify_generate', methods=['POST'])
 def verify_generate():
     try:
-        item_count = int(request.form.get('item_count', 0))
-        food_names = []
-        custom_data = {}
-        
-        for i in range(item_count):
-            name = request.form.get(f'name_{i}')
-            calories = request.form.get(f'calories_{i}')
-            # Allergens are now checkboxes, so getlist
-            allergens_list = request.form.getlist(f'allergens_{i}')
-            
-            if name:
-                food_names.append(name)
-                custom_data[name] = {
-                    'calories': int(calories) if calories else 0,
-                    'allergens': allergens_list # List of strings
-                }
+        food_names, custom_data = _verify_form_items()
         
-        output_file, _ = generate_excel(food_names, custom_data=custom_data)
+        # Re-generating from the same browser session only re-patches the edited rows
+        render_key = session.setdefault('render_key', uuid.uuid4().hex)
+        with admit():
+            output_file, _ = generate_excel(food_names, custom_data=custom_data, session_key=f"web-{render_key}")
         return send_file(output_file, as_attachment=True)
         
+    except Overloaded as e:
+        # Show the same form again, so the user's edits survive until they retry
+        flash(f"{e} Your edits are kept; submit again in {e.retry_after}s.", 'warning')
+        items = [{'name': name, 'calories': custom_data[name]['calories'],
+                  'allergens_list': custom_data[name]['allergens']} for name in food_names]
+        return (render_template('verify.html', items=items, valid_allergens=VALID_ALLERGENS),
+                e.status, {'Retry-After': str(e.retry_after)})
     except Exception as e:
         flash(f"Error generating file: {str(e)}", 'error')
         return redirect(url_for('index'))
 
+def _import_bulk_file(path, upsert):
+    """Parses a bulk upload workbook and writes its rows. Returns: (items, upsert result, rejected rows)."""
+    rejected = []
+    items = process_bulk_upload_excel(path, rejected=rejected)
+    # 'upsert' updates existing items whose values changed; default only adds
+    result = upsert_foods(items, update_existing=upsert)
+    return items, result, rejected
+
+def _finalized_upload_file(upload_id):
+    """Returns: (upload, path) of a finished chunked upload, or raises UploadError."""
+    with span('upload.finalize'):
+        return finalize_upload(upload_id)
+
 @app.route('/bulk_upload', methods=['POST'])
 def bulk_upload():
+    upsert = request.form.get('mode') == 'upsert'
+    # Large files arrive in chunks through /api/uploads; the form then only names the upload
+    upload_id = request.form.get('upload_id')
+    if upload_id:
+        _, temp_path = _finalized_upload_file(upload_id)
+        try:
+            items, result, rejected = _import_bulk_file(temp_path, upsert)
+        finally:
+            discard_upload(upload_id)
+        _flash_bulk_result(items, result, rejected)
+        return redirect(url_for('index', tab='upload'))
+
     if 'file' not in request.files:
         flash('No file part', 'error')
         return redirect(url_for('index', tab='upload'))
@@ -131,36 +293,42 @@ def bulk_upload():
         temp_path = os.path.join(os.path.dirname(__file__), 'data', 'temp_upload.xlsx')
         file.save(temp_path)
         
-        items = process_bulk_upload_excel(temp_path)
-        
-        added_count = 0
-        duplicates = []
-        
-        for item in items:
-            if get_food(item['name']):
-                duplicates.append(item['name'])
-            else:
-                add_food(item['name'], item['calories'], item['allergens'])
-                added_count += 1
+        items, result, rejected = _import_bulk_file(temp_path, upsert)
                 
         # Clean up
         if os.path.exists(temp_path):
             os.remove(temp_path)
             
-        if added_count > 0:
-             flash(f"Successfully added {added_count} items.", 'success')
-        
-        if duplicates:
-            flash(f"Skipped {len(duplicates)} duplicate items: {', '.join(duplicates[:5])}...", 'warning')
-            
-        if added_count == 0 and not duplicates:
-             flash("No valid items found in file.", 'warning')
-
+        _flash_bulk_result(items, result, rejected)
         return redirect(url_for('index', tab='upload'))
     else:
         flash('Invalid file type. Please upload .xlsx', 'error')
         return redirect(url_for('index', tab='upload'))
 
+def _flash_bulk_result(items, result, rejected):
+    added_count = len(result['added'])
+    duplicates = result['skipped']
+
+    if added_count > 0:
+         flash(f"Successfully added {added_count} items.", 'success')
+    
+    if result['updated']:
+         flash(f"Updated {len(result['updated'])} items.", 'success')
+    
+    if result['unchanged']:
+         flash(f"{len(result['unchanged'])} items were already up to date.", 'success')
+    
+    if duplicates:
+        flash(f"Skipped {len(duplicates)} duplicate items: {', '.join(duplicates[:5])}...", 'warning')
+    
+    if rejected:
+        report_url = url_for('download_file', filename=os.path.basename(write_rejection_report(rejected)))
+        flash(Markup(f"Rejected {len(rejected)} rows: {Markup.escape(', '.join(r['name'] for r in rejected[:5]))}... "
+                     f"<a href=\"{report_url}\">Download error report</a>"), 'warning')
+        
+    if not items and not rejected:
+         flash("No valid items found in file.", 'warning')
+
 @app.route('/add_single_item', methods=['POST'])
 def add_single_item():
     name = request.form.get('name')
@@ -181,63 +349,106 @@ def add_single_item():
     flash(f'Success: "{clean_name}" added to database.', 'success')
     return redirect(url_for('index', tab='single'))
 
+def _extract_uploads():
+    """
+    Runs batch name extraction over the uploaded .xlsx/.zip files of the current request.
+    Form/query options: 'range' (e.g. D2:D60) and 'sheets' ('all' or 'active').
+    Returns: (items, stats, error message)
+    """
+    files = [f for f in request.files.getlist('file') if f.filename]
+    if not files:
+        return [], {}, 'No selected file'
+    if any(not f.filename.lower().endswith(('.xlsx', '.zip')) for f in files):
+        return [], {}, 'Invalid file type. Please upload .xlsx or .zip'
+
+    all_sheets = request.values.get('sheets', 'all') != 'active'
+    try:
+        items, stats = extract_names_batch([(f.filename, f.read()) for f in files],
+                                           cell_range=request.values.get('range') or None, all_sheets=all_sheets)
+    except ArchiveTooLarge as e:
+        return [], {}, str(e)
+    except ValueError:
+        return [], {}, f"Invalid cell range: {request.values.get('range')}"
+    return items, stats, None
+
 @app.route('/extract_names', methods=['POST'])
 def extract_names():
     if 'file' not in request.files:
         flash('No file part', 'error')
         return redirect(url_for('index', tab='extract'))
-    
-    file = request.files['file']
-    if file.filename == '':
-        flash('No selected file', 'error')
-        return redirect(url_for('index', tab='extract'))
-        
-    if file and file.filename.endswith('.xlsx'):
-        temp_path = os.path.join(os.path.dirname(__file__), 'data', 'temp_extract.xlsx')
-        file.save(temp_path)
-        
-        extracted_names = extract_names_from_excel(temp_path)
-        
-        # Clean up
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-            
-        if not extracted_names:
-             flash("No valid names found in D2:D60.", 'warning')
-             return redirect(url_for('index', tab='extract'))
-             
-        # Render index with extracted names to show in the text area
-        # We pass 'extracted_names' which index.html checks
-        return render_template('index.html', extracted_names=extracted_names, active_tab='extract')
-    else:
-        flash('Invalid file type. Please upload .xlsx', 'error')
+
+    items, stats, error = _extract_uploads()
+    if error:
+        flash(error, 'error')
         return redirect(url_for('index', tab='extract'))
 
+    if not items:
+         flash(f"No valid names found in {request.form.get('range') or EXTRACT_RANGE}.", 'warning')
+         return redirect(url_for('index', tab='extract'))
+
+    # Render index with extracted names to show in the text area
+    # We pass 'extracted_names' which index.html checks
+    return render_template('index.html', extracted_names=[i['name'] for i in items], extracted_items=items,
+                           extract_stats=stats, active_tab='extract')
+
+def _parse_menu_form(name, dishes, schedule):
+    """
+    Validates saved menu input.
+    Returns: (clean name, clean dishes list, clean schedule, error message)
+    """
+    name = (name or '').strip()
+    dishes = [str(d).strip().upper() for d in dishes if str(d).strip()]
+    schedule = (schedule or '').strip()
+    if not name or not dishes:
+        return name, dishes, schedule, 'Menu name and at least one dish are required.'
+    if schedule:
+        try:
+            parse_schedule(schedule)
+        except ValueError as e:
+            return name, dishes, schedule, str(e)
+    return name, dishes, schedule, None
+
+@app.route('/save_menu', methods=['POST'])
+def save_menu_route():
+    name, dishes, schedule, error = _parse_menu_form(
+        request.form.get('menu_name'),
+        (request.form.get('dishes') or '').splitlines(),
+        request.form.get('schedule')
+    )
+    if error:
+        flash(error, 'error')
+        return redirect(url_for('index', tab='menus'))
+
+    save_menu(name, request.form.get('outlet', '').strip(), dishes, schedule)
+    flash(f'Saved menu "{name}" with {len(dishes)} dishes.', 'success')
+    return redirect(url_for('index', tab='menus'))
+
+@app.route('/menus/<name>')
+def download_menu(name):
+    output_file, _ = get_saved_menu_file(name, limiter=admit)
+    if not output_file:
+        flash(f'Menu "{name}" not found.', 'error')
+        return redirect(url_for('index', tab='menus'))
+    return send_file(output_file, as_attachment=True)
+
 # API Endpoints
 @app.route('/api/extract_names', methods=['POST'])
 def api_extract_names():
     if 'file' not in request.files:
         return {'error': 'No file part'}, 400
-        
-    file = request.files['file']
-    if file.filename == '':
-        return {'error': 'No selected file'}, 400
-        
-    if file and file.filename.endswith('.xlsx'):
-        temp_path = os.path.join(os.path.dirname(__file__), 'data', 'api_temp_extract.xlsx')
-        file.save(temp_path)
-        
-        extracted_names = extract_names_from_excel(temp_path)
-        
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-            
-        return {
-            'status': 'success',
-            'count': len(extracted_names),
-            'names': extracted_names
-        }
-    return {'error': 'Invalid file type. Please upload .xlsx'}, 400
+
+    items, stats, error = _extract_uploads()
+    if error:
+        return {'error': error}, 400
+
+    return {
+        'status': 'success',
+        'count': len(items),
+        'names': [i['name'] for i in items],
+        'items': items,
+        'files': stats['files'],
+        'sheets': stats['sheets']
+    }
 
 @app.route('/api/process', methods=['POST'])
 def api_process():
@@ -262,7 +473,8 @@ def api_process():
         }
         
     # Generate Excel
-    output_file, _ = generate_excel(food_names)
+    with admit(), span('generate_excel', rows=len(food_names)):
+        output_file, _ = generate_excel(food_names)
     
     # Generate a download URL (assuming server is accessible via IP/domain)
     # Since this is an API, we can return the full path or a relative URL
@@ -291,6 +503,61 @@ def api_add_food():
     
     return {'status': 'success', 'message': f'Food "{name}" added.'}
 
+@app.route('/api/add_foods', methods=['POST'])
+def api_add_foods():
+    """Adds several foods in one transaction. Existing names are skipped, never updated."""
+    data = request.get_json()
+    if not data or not isinstance(data.get('foods'), list):
+        return {'error': 'Invalid request. "foods" list required.'}, 400
+
+    items = []
+    invalid = []
+    for food in data['foods']:
+        if not isinstance(food, dict):
+            invalid.append({'food': food, 'reason': 'Not an object'})
+            continue
+        name = str(food.get('name') or '').strip().upper()
+        try:
+            calories = int(food['calories'])
+        except (KeyError, TypeError, ValueError):
+            calories = -1
+        # A list or a comma-separated string, in any accepted spelling (stored canonical)
+        raw_allergens = food.get('allergens') or []
+        if isinstance(raw_allergens, str):
+            raw_allergens = raw_allergens.split(',')
+        elif not isinstance(raw_allergens, list):
+            raw_allergens = [raw_allergens]
+        allergens = []
+        unknown = []
+        for value in raw_allergens:
+            if not str(value).strip():
+                continue
+            allergen = canonical_allergen(value)
+            if not allergen:
+                unknown.append(str(value))
+            elif allergen not in allergens:
+                allergens.append(allergen)
+
+        if not name:
+            invalid.append(dict(food, reason='Missing name'))
+        elif calories < 0:
+            invalid.append(dict(food, reason=f"Invalid calories: {food.get('calories')}"))
+        elif unknown:
+            invalid.append(dict(food, reason=f"Unknown allergen: {', '.join(unknown)}"))
+        else:
+            items.append({'name': name, 'calories': calories, 'allergens': allergens})
+
+    result = upsert_foods(items, update_existing=False)
+    return {
+        'status': 'success',
+        'added_count': len(result['added']),
+        'skipped_count': len(result['skipped']),
+        'invalid_count': len(invalid),
+        'added_items': result['added'],
+        'skipped_duplicates': result['skipped'],
+        'invalid_items': invalid
+    }
+
 @app.route('/api/bulk_upload', methods=['POST'])
 def api_bulk_upload():
     if 'file' not in request.files:
@@ -304,30 +571,72 @@ def api_bulk_upload():
         temp_path = os.path.join(os.path.dirname(__file__), 'data', 'api_temp_upload.xlsx')
         file.save(temp_path)
         
-        items = process_bulk_upload_excel(temp_path)
-        
-        added = []
-        duplicates = []
-        
-        for item in items:
-            if get_food(item['name']):
-                duplicates.append(item['name'])
-            else:
-                add_food(item['name'], item['calories'], item['allergens'])
-                added.append(item['name'])
+        upsert = request.form.get('mode') == 'upsert'
+        items, result, rejected = _import_bulk_file(temp_path, upsert)
                 
         if os.path.exists(temp_path):
             os.remove(temp_path)
-            
-        return {
-            'status': 'success',
-            'added_count': len(added),
-            'skipped_count': len(duplicates),
-            'added_items': added,
-            'skipped_duplicates': duplicates
-        }
+
+        return _bulk_upload_response(result, rejected, upsert)
     return {'error': 'Invalid file type. Please upload .xlsx'}, 400
 
+def _bulk_upload_response(result, rejected, upsert):
+    error_report_url = None
+    if rejected:
+        report_file = write_rejection_report(rejected)
+        error_report_url = url_for('download_file', filename=os.path.basename(report_file), _external=True)
+        
+    return {
+        'status': 'success',
+        'mode': 'upsert' if upsert else 'add',
+        'added_count': len(result['added']),
+        'updated_count': len(result['updated']),
+        'unchanged_count': len(result['unchanged']),
+        'skipped_count': len(result['skipped']),
+        'rejected_count': len(rejected),
+        'added_items': result['added'],
+        'updated_items': result['updated'],
+        'skipped_duplicates': result['skipped'],
+        'rejected_rows': rejected,
+        'error_report_url': error_report_url
+    }
+
+@app.route('/api/uploads', methods=['POST'])
+def api_create_upload():
+    """Starts a chunked upload: {'filename', 'size', 'sha256', 'mode'}."""
+    data = request.get_json(silent=True) or {}
+    upload = create_upload(data.get('filename'), data.get('size'), data.get('sha256'),
+                           mode='upsert' if data.get('mode') == 'upsert' else 'add')
+    return {'status': 'success', 'chunk_size': UPLOAD_CHUNK_SIZE, **upload}, 201
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def api_get_upload(upload_id):
+    """Where to resume: the bytes received so far are in 'offset'."""
+    return {'status': 'success', **get_upload(upload_id)}
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+def api_append_upload(upload_id):
+    try:
+        offset = int(request.args.get('offset', ''))
+    except ValueError:
+        return {'error': 'Invalid offset.'}, 400
+    data = request.get_data(cache=False)
+    with span('upload.chunk', offset=offset, size=len(data)):
+        new_offset = append_chunk(upload_id, offset, data, request.headers.get('X-Chunk-Sha256'))
+    return {'status': 'success', 'offset': new_offset}
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+def api_finalize_upload(upload_id):
+    """Checks the assembled file and imports it. Returns the /api/bulk_upload response."""
+    upload, temp_path = _finalized_upload_file(upload_id)
+    data = request.get_json(silent=True) or {}
+    upsert = data.get('mode', upload.get('mode')) == 'upsert'
+    try:
+        items, result, rejected = _import_bulk_file(temp_path, upsert)
+    finally:
+        discard_upload(upload_id)
+    return _bulk_upload_response(result, rejected, upsert)
+
 @app.route('/api/get_details', methods=['POST'])
 def api_get_details():
     data = request.get_json()
@@ -378,24 +687,243 @@ def api_generate_custom():
         }
     
     try:
-        output_file, _ = generate_excel(food_names, custom_data=custom_data)
+        # Optional client session id lets repeated generations patch the last render
+        session_id = data.get('session_id')
+        session_key = f"api-{session_id}" if session_id else None
+        with admit(), span('generate_excel', rows=len(food_names), session=bool(session_key)):
+            output_file, _ = generate_excel(food_names, custom_data=custom_data, session_key=session_key)
         download_url = url_for('download_file', filename=os.path.basename(output_file), _external=True)
         
         return {
             'status': 'complete',
             'download_url': download_url
         }
+    except Overloaded:
+        raise
     except Exception as e:
         print(f"Generate Error: {e}")
         return {'error': str(e)}, 500
 
+@app.route('/api/preview', methods=['POST'])
+def api_preview():
+    """
+    Returns the rows /api/generate_custom (list of objects) or /api/process (list of names)
+    would write, without building a workbook.
+    """
+    data = request.get_json()
+    if not data or not isinstance(data.get('foods'), list):
+        return {'error': 'Invalid request. "foods" list of names or objects required.'}, 400
+
+    food_names = []
+    custom_data = {}
+    for f in data['foods']:
+        if isinstance(f, dict):
+            name = f.get('name')
+            if not isinstance(name, str) or not name.strip():
+                return {'error': 'Every food object needs a "name" string.'}, 400
+            allergens = f.get('allergens') or []
+            if not isinstance(allergens, (list, str)):
+                return {'error': f'"allergens" of {name} must be a list or a comma-separated string.'}, 400
+            food_names.append(name)
+            custom_data[name] = {
+                'calories': f.get('calories', 0),
+                'allergens': allergens
+            }
+        elif isinstance(f, (str, int, float)) and str(f).strip():
+            food_names.append(str(f))
+        else:
+            return {'error': 'Every food must be a name or an object with a "name".'}, 400
+
+    try:
+        with span('preview_rows', rows=len(food_names)):
+            preview = preview_rows(food_names, custom_data=custom_data or None)
+        return {'status': 'success', **preview}
+    except Exception as e:
+        print(f"Preview Error: {e}")
+        return {'error': str(e)}, 500
+
+@app.route('/api/allergen_summary', methods=['POST'])
+def api_allergen_summary():
+    """
+    Allergen overview of {'foods': [names]} or {'menu': saved menu name}.
+    With 'sheet': true the response also links a summary workbook.
+    """
+    data = request.get_json()
+    if not data or not (isinstance(data.get('foods'), list) or data.get('menu')):
+        return {'error': 'Invalid request. "foods" list or "menu" name required.'}, 400
+
+    if data.get('menu'):
+        menu = get_menu(str(data['menu']).strip())
+        if not menu:
+            return {'error': f'Menu "{data["menu"]}" not found.'}, 404
+        food_names = menu['dishes']
+    else:
+        food_names = [str(f) for f in data['foods']]
+
+    try:
+        with span('allergen_summary', rows=len(food_names)):
+            summary = allergen_summary(food_names)
+        if data.get('sheet'):
+            output_file = write_allergen_summary(summary, title=data.get('menu', ''))
+            summary['download_url'] = url_for('download_file', filename=os.path.basename(output_file), _external=True)
+        return {'status': 'success', **summary}
+    except Exception as e:
+        print(f"Allergen Summary Error: {e}")
+        return {'error': str(e)}, 500
+
+@app.route('/api/menus', methods=['GET'])
+def api_list_menus():
+    menus = list_menus()
+    return {
+        'status': 'success',
+        'menus': [{
+            'name': m['name'],
+            'outlet': m['outlet'],
+            'schedule': m['schedule'],
+            'dishes': m['dishes'],
+            'ready': bool(m['rendered_file']) and not m['stale'],
+            'rendered_at': m['rendered_at'],
+            'missing_items': m['missing']
+        } for m in menus]
+    }
+
+@app.route('/api/menus', methods=['POST'])
+def api_save_menu():
+    data = request.get_json()
+    if not data or 'name' not in data or 'dishes' not in data:
+        return {'error': 'Invalid request. "name" and "dishes" list required.'}, 400
+
+    name, dishes, schedule, error = _parse_menu_form(data['name'], data['dishes'], data.get('schedule'))
+    if error:
+        return {'error': error}, 400
+
+    save_menu(name, str(data.get('outlet', '')).strip(), dishes, schedule)
+    return {'status': 'success', 'message': f'Menu "{name}" saved.'}
+
+@app.route('/api/menus/<name>', methods=['GET'])
+def api_get_menu(name):
+    output_file, missing = get_saved_menu_file(name, limiter=admit)
+    if not output_file:
+        return {'error': f'Menu "{name}" not found.'}, 404
+
+    download_url = url_for('download_file', filename=os.path.basename(output_file), _external=True)
+    return {
+        'status': 'complete',
+        'download_url': download_url,
+        'missing_items': missing
+    }
+
+@app.route('/api/menus/<name>', methods=['DELETE'])
+def api_delete_menu(name):
+    menu = get_menu(name)
+    if not menu or not delete_menu(name):
+        return {'error': f'Menu "{name}" not found.'}, 404
+    remove_rendered_file(menu)
+    return {'status': 'success', 'message': f'Menu "{name}" deleted.'}
+
+@app.route('/api/foods', methods=['GET'])
+def api_foods():
+    """Browse/search the catalogue: ?prefix=CHI&cursor=<last name>&limit=20"""
+    try:
+        limit = max(1, min(int(request.args.get('limit', 20)), 200))
+    except ValueError:
+        return {'error': 'Invalid limit.'}, 400
+
+    items = search_foods(
+        prefix=request.args.get('prefix', ''),
+        after=request.args.get('cursor', ''),
+        limit=limit
+    )
+    return {
+        'status': 'success',
+        'items': items,
+        # Pass back as ?cursor= for the next page; None when this is the last one
+        'next_cursor': items[-1]['name'] if len(items) == limit else None
+    }
+
+@app.route('/api/changes', methods=['GET'])
+def api_changes():
+    """Catalogue change feed: ?since=<cursor from the previous call> (0 for everything)."""
+    try:
+        limit = max(1, min(int(request.args.get('limit', 1000)), 5000))
+        changes, cursor, has_more = get_changes(request.args.get('since', '0'), limit)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    return {
+        'status': 'success',
+        'changes': changes,
+        'cursor': cursor,
+        'has_more': has_more
+    }
+
+@app.route('/api/export', methods=['GET'])
+def api_export():
+    """Full catalogue in the bulk upload format: ?format=csv (default xlsx)."""
+    export_format = request.args.get('format', 'xlsx').lower()
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    if export_format == 'csv':
+        # The body is produced after this request's teardown, so carry the property along
+        property_key = get_property()
+
+        def generate():
+            with use_property(property_key):
+                yield from export_catalogue_csv()
+
+        return Response(
+            generate(),
+            mimetype='text/csv',
+            headers={'Content-Disposition': f'attachment; filename=Catalogue_{timestamp}.csv'}
+        )
+    if export_format != 'xlsx':
+        return {'error': 'Invalid format. Use "csv" or "xlsx".'}, 400
+
+    export_path = export_catalogue_xlsx()
+    export_file = open(export_path, 'rb')
+    # The open handle keeps the data readable; the directory entry goes away now
+    os.remove(export_path)
+    return send_file(export_file, as_attachment=True, download_name=f"Catalogue_{timestamp}.xlsx",
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+@app.route('/api/admin/memory', methods=['GET'])
+def api_admin_memory():
+    """RSS and per-route memory growth of every worker (top allocators with MEMORY_PROFILE=1)."""
+    if not _is_admin_request():
+        return {'error': 'Unauthorized.'}, 403
+    return {
+        'status': 'success',
+        'worker': os.getpid(),
+        'profiling': memwatch.MEMORY_PROFILE,
+        'limit_mb': memwatch.MEMORY_LIMIT_MB,
+        'workers': memwatch.all_worker_stats()
+    }
+
+@app.route('/api/properties', methods=['GET'])
+def api_properties():
+    return {'status': 'success', 'properties': list_properties()}
+
+@app.route('/api/admin/properties', methods=['POST'])
+def api_create_property():
+    """Creates a property's catalogue. Properties must exist before requests can select them."""
+    if not _is_admin_request():
+        return {'error': 'Unauthorized.'}, 403
+    data = request.json or {}
+    try:
+        key = create_property(data.get('key'))
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    return {'status': 'success', 'property': key}, 201
+
 @app.route('/download/<filename>')
 def download_file(filename):
-    file_path = os.path.join(os.path.dirname(__file__), 'data', 'output', filename)
+    file_path = os.path.join(OUTPUT_DIR, filename)
     if os.path.exists(file_path):
         return send_file(file_path, as_attachment=True)
     return {'error': 'File not found'}, 404
 
 if __name__ == '__main__':
+    # Under gunicorn, gunicorn.conf.py's on_starting hook does this once for all workers
+    init_db()
     # Listen on all interfaces
     app.run(host='0.0.0.0', port=5000, debug=True)
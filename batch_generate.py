@@ -0,0 +1,153 @@
+"""
+Offline batch tag generation for folders of menu text files.
+
+Each menu file lists one dish per line (blank lines and lines starting with '#' are
+ignored). All dishes of all menus are looked up in one catalogue pass, then the
+workbooks are rendered in parallel across a process pool. Dishes the catalogue does
+not know are written to a summary CSV (menu, dish).
+
+Examples:
+    # Render every .txt menu in a shared folder
+    python batch_generate.py /mnt/menus --out /mnt/menus/tags
+
+    # Nightly check only: report missing dishes, exit 1 if there are any
+    python batch_generate.py "/mnt/menus/*/week*.txt" --check --property cal27
+"""
+import argparse
+import csv
+import glob
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from database import get_foods, init_db, reset_property, set_property, use_property
+from excel_utils import render_menu_file, MAX_ITEMS, OUTPUT_DIR
+
+
+def find_menu_files(paths, pattern):
+    """Expands directories (matching `pattern`) and globs. Returns: sorted unique file paths."""
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            files.update(glob.glob(os.path.join(path, pattern)))
+        else:
+            files.update(p for p in glob.glob(path) if os.path.isfile(p))
+    return sorted(files)
+
+
+def read_menu(path):
+    """Returns: the menu's dish names, cleaned like generate_excel does (stripped, upper case)."""
+    with open(path, encoding='utf-8-sig') as f:
+        lines = [line.strip() for line in f]
+    return [line.upper() for line in lines if line and not line.startswith('#')]
+
+
+def output_names(menu_files):
+    """Returns: one output file name per menu, from the menu's file name (suffixed if two menus share it)."""
+    seen = Counter()
+    names = []
+    for path in menu_files:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        seen[stem] += 1
+        names.append(f"Buffet_Tags_{stem}.xlsx" if seen[stem] == 1 else f"Buffet_Tags_{stem}_{seen[stem]}.xlsx")
+    return names
+
+
+def render_job(job):
+    """Process pool task. Returns: (menu path, output file, missing dishes, seconds)."""
+    menu_path, output_file, dishes, catalogue = job
+    start = time.perf_counter()
+    # Each process keeps its last workbook and only rewrites the rows that differ
+    missing = render_menu_file(output_file, dishes, catalogue, session_key='batch')
+    return menu_path, output_file, missing, time.perf_counter() - start
+
+
+def write_summary(path, missing_by_menu):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Menu', 'Missing Dish'])
+        for menu_path, missing in missing_by_menu.items():
+            for dish in missing:
+                writer.writerow([menu_path, dish])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate buffet tag workbooks for many menu text files at once.")
+    parser.add_argument('paths', nargs='+', help="Menu files, directories or glob patterns")
+    parser.add_argument('--pattern', default='*.txt', help="File pattern used inside directories")
+    parser.add_argument('--out', default=OUTPUT_DIR, help="Folder for the generated workbooks")
+    parser.add_argument('--summary', default='', help="Missing dishes CSV (default: <out>/missing_dishes.csv)")
+    parser.add_argument('--property', default='', help="Property catalogue to use (default: global)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Render processes")
+    parser.add_argument('--check', action='store_true', help="Only report missing dishes, render nothing")
+    args = parser.parse_args()
+
+    menu_files = find_menu_files(args.paths, args.pattern)
+    if not menu_files:
+        print("No menu files found.")
+        return 1
+
+    try:
+        # Fail before any work when the property has no catalogue
+        reset_property(set_property(args.property or None))
+    except ValueError as e:
+        print(e)
+        return 1
+
+    start = time.perf_counter()
+    menus = {path: read_menu(path) for path in menu_files}
+
+    # One catalogue pass for every dish of every menu
+    init_db()
+    wanted = {name for dishes in menus.values() for name in dishes[:MAX_ITEMS]}
+    with use_property(args.property or None):
+        # Plain dicts: sqlite3.Row does not pickle into the render processes
+        catalogue = {name: dict(row) for name, row in get_foods(sorted(wanted)).items()}
+    lookup_time = time.perf_counter() - start
+
+    missing_by_menu = {}
+    truncated = [path for path, dishes in menus.items() if len(dishes) > MAX_ITEMS]
+    rendered = 0
+    if args.check:
+        for path, dishes in menus.items():
+            missing_by_menu[path] = [name for name in dishes[:MAX_ITEMS] if name not in catalogue]
+    else:
+        os.makedirs(args.out, exist_ok=True)
+        jobs = [
+            (path, os.path.join(args.out, out_name), menus[path],
+             {name: catalogue[name] for name in menus[path][:MAX_ITEMS] if name in catalogue})
+            for path, out_name in zip(menu_files, output_names(menu_files))
+        ]
+        workers = max(1, min(args.workers, len(jobs)))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunksize = max(1, len(jobs) // (workers * 4))
+            for menu_path, output_file, missing, _ in pool.map(render_job, jobs, chunksize=chunksize):
+                missing_by_menu[menu_path] = missing
+                rendered += 1
+
+    summary_path = args.summary or os.path.join(args.out, 'missing_dishes.csv')
+    if not os.path.isdir(os.path.dirname(os.path.abspath(summary_path))):
+        os.makedirs(os.path.dirname(os.path.abspath(summary_path)))
+    write_summary(summary_path, missing_by_menu)
+
+    elapsed = time.perf_counter() - start
+    incomplete = {path: missing for path, missing in missing_by_menu.items() if missing}
+    counts = Counter(dish for missing in incomplete.values() for dish in set(missing))
+    action = "Checked" if args.check else f"Rendered {rendered} of"
+    print(f"{action} {len(menu_files)} menus ({len(wanted)} distinct dishes) in {elapsed:.2f}s "
+          f"(catalogue lookup {lookup_time:.2f}s).")
+    for path in truncated:
+        print(f"Only the first {MAX_ITEMS} of {len(menus[path])} dishes are used: {path}")
+    if incomplete:
+        print(f"{len(incomplete)} menus have missing dishes ({len(counts)} distinct); see {summary_path}")
+        for dish, n in counts.most_common(10):
+            print(f"  {dish}: {n} menus")
+    else:
+        print("No missing dishes.")
+    return 1 if incomplete else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,15 +1,147 @@
+import contextvars
+import queue
+import re
 import sqlite3
 import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
-DB_PATH = os.path.join(os.path.dirname(__file__), 'data', 'food_database.db')
+# Global tier: dishes shared by every property, and the only tier when no property is selected
+DB_PATH = os.getenv('FOOD_DB_PATH', os.path.join(os.path.dirname(__file__), 'data', 'food_database.db'))
+# One database file per property (e.g. data/properties/cal27.db), so properties never share a write lock
+PROPERTY_DB_DIR = os.getenv('PROPERTY_DB_DIR', os.path.join(os.path.dirname(__file__), 'data', 'properties'))
+# Properties whose database is created by init_db (comma separated). Any other key must
+# already have a database, made through create_property(), so a typo never becomes a shard.
+PROPERTIES = [k.strip().lower() for k in os.getenv('PROPERTIES', '').split(',') if k.strip()]
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+_PROPERTY_KEY_RE = re.compile(r'^[a-z0-9_-]{1,40}$')
+# Property of the current request / bot update / scheduler run; None means global only
+_current_property = contextvars.ContextVar('current_property', default=None)
+
+# Idle connections per database file: {path: Queue}
+_pools = {}
+_pools_lock = threading.Lock()
+
+# First pages of recently searched prefixes: {(property, prefix, limit): (timestamp, rows)}.
+# Writes in this process clear it; the TTL bounds staleness from writes in other workers.
+PREFIX_CACHE_SIZE = int(os.getenv('PREFIX_CACHE_SIZE', '256'))
+PREFIX_CACHE_TTL = float(os.getenv('PREFIX_CACHE_TTL', '30'))
+_prefix_cache = OrderedDict()
+_prefix_cache_lock = threading.Lock()
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection whose close() returns it to its pool instead of closing it."""
+    pool = None
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+        if self.pool is not None:
+            try:
+                self.pool.put_nowait(self)
+                return
+            except queue.Full:
+                pass
+        super().close()
+
+# --- Property Routing ---
+
+def normalize_property(key):
+    """
+    Returns: the canonical property key (lower case), or None for empty input.
+    Raises ValueError for keys that are not safe to use as a file name.
+    """
+    if key is None:
+        return None
+    key = str(key).strip().lower()
+    if not key:
+        return None
+    if not _PROPERTY_KEY_RE.match(key):
+        raise ValueError(f'Invalid property "{key}". Use letters, digits, "-" or "_".')
+    return key
+
+def set_property(key):
+    """
+    Selects the property for the current context. Returns: token for reset_property().
+    Raises ValueError for invalid keys and for properties that have no database.
+    """
+    key = normalize_property(key)
+    if key and not property_exists(key):
+        raise ValueError(f'Unknown property "{key}".')
+    return _current_property.set(key)
+
+def reset_property(token):
+    _current_property.reset(token)
+
+def get_property():
+    return _current_property.get()
+
+@contextmanager
+def use_property(key):
+    token = set_property(key)
+    try:
+        yield
+    finally:
+        reset_property(token)
+
+def list_properties():
+    if not os.path.isdir(PROPERTY_DB_DIR):
+        return []
+    return sorted(f[:-3] for f in os.listdir(PROPERTY_DB_DIR) if f.endswith('.db'))
+
+def _property_db_path(key):
+    return os.path.join(PROPERTY_DB_DIR, f"{key}.db")
+
+def property_exists(key):
+    return os.path.exists(_property_db_path(key))
+
+def create_property(key):
+    """
+    Creates the database of a property (no-op when it exists).
+    Returns: the canonical key. Raises ValueError for invalid or empty keys.
+    """
+    key = normalize_property(key)
+    if not key:
+        raise ValueError("Property key is required.")
+    os.makedirs(PROPERTY_DB_DIR, exist_ok=True)
+    _migrate(_property_db_path(key))
+    return key
+
+def _get_pool(path):
+    with _pools_lock:
+        pool = _pools.get(path)
+        if pool is None:
+            pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+            _pools[path] = pool
+        return pool
+
+def get_db_connection(global_tier=False):
+    """
+    Returns a pooled connection to the current property's database, or to the global
+    database when no property is selected or global_tier is True.
+    """
+    key = None if global_tier else _current_property.get()
+    path = _property_db_path(key) if key else DB_PATH
+    pool = _get_pool(path)
+    try:
+        return pool.get_nowait()
+    except queue.Empty:
+        pass
+    conn = sqlite3.connect(path, factory=PooledConnection, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    conn.pool = pool
     return conn
 
-def init_db():
-    conn = get_db_connection()
+def _read_connections():
+    """Yields connections to read from, highest precedence first: property tier, then global tier."""
+    if _current_property.get():
+        yield get_db_connection()
+    yield get_db_connection(global_tier=True)
+
+def _create_tables(conn):
     conn.execute('''
         CREATE TABLE IF NOT EXISTS food_items (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -19,15 +151,74 @@ def init_db():
         )
     ''')
     # allergens will be a comma-separated string of allergen names present in the food (e.g. "Fish,Egg")
+
+    # Saved recurring menus. Dishes keep their order via position and are indexed by dish
+    # so a catalogue change can flag every menu that needs re-rendering.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS saved_menus (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            outlet TEXT,
+            schedule TEXT,
+            rendered_file TEXT,
+            rendered_at TEXT,
+            missing TEXT,
+            stale INTEGER NOT NULL DEFAULT 1
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS saved_menu_dishes (
+            menu_id INTEGER NOT NULL REFERENCES saved_menus(id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            dish TEXT NOT NULL,
+            PRIMARY KEY (menu_id, position)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_saved_menu_dishes_dish ON saved_menu_dishes (dish)')
+
+    # Append-only change feed of food_items, so clients can mirror the catalogue with deltas
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS food_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            calories INTEGER,
+            allergens TEXT,
+            changed_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Seed the feed once with the items that existed before it did
+    if conn.execute('SELECT 1 FROM food_changes LIMIT 1').fetchone() is None:
+        conn.execute('INSERT INTO food_changes (name, calories, allergens) '
+                     'SELECT name, calories, allergens FROM food_items ORDER BY id')
     conn.commit()
-    conn.close()
+
+def _migrate(path):
+    # Unpooled: init_db runs in gunicorn's master, whose connections must not leak into forked workers
+    conn = sqlite3.connect(path)
+    try:
+        _create_tables(conn)
+    finally:
+        conn.close()
+
+def init_db():
+    """Creates or migrates every database. Run once per start (gunicorn's on_starting, CLI tools), not per worker."""
+    _migrate(DB_PATH)
+    for key in PROPERTIES:
+        create_property(key)
+    for key in list_properties():
+        _migrate(_property_db_path(key))
     print("Database initialized.")
 
 def get_food(name):
-    conn = get_db_connection()
-    food = conn.execute('SELECT * FROM food_items WHERE name = ?', (name,)).fetchone()
-    conn.close()
-    return food
+    """Returns: the row for name from the current property, falling back to the global tier."""
+    for conn in _read_connections():
+        try:
+            food = conn.execute('SELECT * FROM food_items WHERE name = ?', (name,)).fetchone()
+        finally:
+            conn.close()
+        if food:
+            return food
+    return None
 
 def add_food(name, calories, allergens_list):
     conn = get_db_connection()
@@ -35,11 +226,322 @@ def add_food(name, calories, allergens_list):
     try:
         conn.execute('INSERT INTO food_items (name, calories, allergens) VALUES (?, ?, ?)',
                      (name, calories, allergens_str))
+        conn.execute('INSERT INTO food_changes (name, calories, allergens) VALUES (?, ?, ?)',
+                     (name, calories, allergens_str))
+        mark_menus_stale([name], conn=conn)
         conn.commit()
+        clear_prefix_cache()
     except sqlite3.IntegrityError:
         print(f"Food {name} already exists.")
+        return
+    finally:
+        conn.close()
+    _mark_property_menus_stale([name])
+
+def _normalize_allergens(allergens):
+    """Returns allergens (list or comma-separated string) as a clean list."""
+    if isinstance(allergens, list):
+        return [str(a).strip() for a in allergens if str(a).strip()]
+    if isinstance(allergens, str) and allergens:
+        return [a.strip() for a in allergens.split(',') if a.strip()]
+    return []
+
+def _get_foods_in(conn, names):
+    found = {}
+    # SQLite caps bound parameters per statement, so query in chunks
+    for i in range(0, len(names), 500):
+        chunk = names[i:i + 500]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(f'SELECT * FROM food_items WHERE name IN ({placeholders})', chunk).fetchall()
+        for row in rows:
+            found[row['name']] = row
+    return found
+
+def get_foods(names):
+    """
+    Fetches many foods at once, from the current property first and the global tier
+    for the rest.
+    Returns: dict {name: row} for the names that exist.
+    """
+    names = list(dict.fromkeys(names))
+    found = {}
+    for conn in _read_connections():
+        try:
+            remaining = [n for n in names if n not in found]
+            if remaining:
+                found.update(_get_foods_in(conn, remaining))
+        finally:
+            conn.close()
+    return found
+
+def upsert_foods(items, update_existing=True):
+    """
+    Writes a batch of foods in a single transaction, to the current property's database
+    (or the global one when no property is selected).
+    items: list of dicts [{'name': '...', 'calories': ..., 'allergens': [...]}]
+    update_existing: if False, existing names are skipped instead of updated.
+    Returns: dict of name lists {'added', 'updated', 'unchanged', 'skipped'}.
+    Rows whose stored values already match cost no writes. A property that changes a
+    global dish gets its own copy of it.
+    """
+    # Last occurrence of a name wins
+    incoming = {}
+    for item in items:
+        incoming[item['name']] = item
+
+    result = {'added': [], 'updated': [], 'unchanged': [], 'skipped': []}
+    if not incoming:
+        return result
+
+    current = get_foods(list(incoming))
+    conn = get_db_connection()
+    try:
+        own = _get_foods_in(conn, list(current))
+
+        inserts = []
+        updates = []
+        for name, item in incoming.items():
+            calories = int(item['calories'])
+            allergens = _normalize_allergens(item['allergens'])
+            existing = current.get(name)
+            if existing is None:
+                inserts.append((name, calories, ",".join(allergens)))
+                result['added'].append(name)
+            elif not update_existing:
+                result['skipped'].append(name)
+            elif existing['calories'] == calories and _normalize_allergens(existing['allergens']) == allergens:
+                result['unchanged'].append(name)
+            else:
+                if name in own:
+                    updates.append((calories, ",".join(allergens), name))
+                else:
+                    inserts.append((name, calories, ",".join(allergens)))
+                result['updated'].append(name)
+
+        if inserts or updates:
+            with conn:
+                conn.executemany('INSERT INTO food_items (name, calories, allergens) VALUES (?, ?, ?)', inserts)
+                conn.executemany('UPDATE food_items SET calories = ?, allergens = ? WHERE name = ?', updates)
+                conn.executemany('INSERT INTO food_changes (name, calories, allergens) VALUES (?, ?, ?)',
+                                 inserts + [(name, calories, allergens) for calories, allergens, name in updates])
+                mark_menus_stale(result['added'] + result['updated'], conn=conn)
+            clear_prefix_cache()
+    finally:
+        conn.close()
+    _mark_property_menus_stale(result['added'] + result['updated'])
+    return result
+
+def _merged_page(after, limit, prefix=''):
+    """
+    First `limit` foods with name > after (and starting with prefix) across the read tiers.
+    Each tier is a keyset range scan on its name index; property rows override global ones.
+    """
+    query = 'SELECT name, calories, allergens FROM food_items WHERE name > ?'
+    params = [after]
+    if prefix:
+        query += ' AND name >= ? AND name < ?'
+        params += [prefix, _prefix_upper_bound(prefix)]
+    query += ' ORDER BY name LIMIT ?'
+    params.append(limit)
+
+    merged = {}
+    for conn in _read_connections():
+        try:
+            for row in conn.execute(query, params).fetchall():
+                merged.setdefault(row['name'], dict(row))
+        finally:
+            conn.close()
+    return [merged[name] for name in sorted(merged)[:limit]]
+
+def iter_foods(batch_size=1000):
+    """
+    Walks the whole catalogue in name order using keyset pagination, so memory stays
+    flat regardless of catalogue size.
+    Yields: lists of row dicts (at most batch_size each).
+    """
+    last_name = ''
+    while True:
+        rows = _merged_page(last_name, batch_size)
+        if not rows:
+            break
+        yield rows
+        last_name = rows[-1]['name']
+
+def _parse_change_cursor(cursor):
+    """Cursor is "<global seq>" or "<global seq>.<property seq>"."""
+    parts = str(cursor or '0').split('.')
+    try:
+        global_seq = int(parts[0] or 0)
+        property_seq = int(parts[1]) if len(parts) > 1 else 0
+    except ValueError:
+        raise ValueError(f'Invalid cursor "{cursor}".')
+    return global_seq, property_seq
+
+def get_changes(cursor='0', limit=1000):
+    """
+    Catalogue changes after cursor, oldest first. Global tier changes come before
+    property tier ones; clients apply property rows over global rows.
+    Returns: (list of {'tier', 'name', 'calories', 'allergens'}, next cursor, has_more)
+    Raises ValueError for malformed cursors.
+    """
+    global_seq, property_seq = _parse_change_cursor(cursor)
+    tiers = [('global', True, global_seq)]
+    if _current_property.get():
+        tiers.append(('property', False, property_seq))
+
+    changes = []
+    has_more = False
+    next_seqs = []
+    for tier, global_tier, since in tiers:
+        conn = get_db_connection(global_tier=global_tier)
+        try:
+            rows = conn.execute('SELECT seq, name, calories, allergens FROM food_changes WHERE seq > ? ORDER BY seq LIMIT ?',
+                                (since, limit)).fetchall()
+        finally:
+            conn.close()
+        has_more = has_more or len(rows) == limit
+        next_seqs.append(rows[-1]['seq'] if rows else since)
+        changes += [{'tier': tier, 'name': r['name'], 'calories': r['calories'], 'allergens': r['allergens'] or ''}
+                    for r in rows]
+
+    return changes, ".".join(str(seq) for seq in next_seqs), has_more
+
+def clear_prefix_cache():
+    with _prefix_cache_lock:
+        _prefix_cache.clear()
+
+def _prefix_upper_bound(prefix):
+    """Smallest string greater than every string starting with prefix."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def search_foods(prefix='', after='', limit=20):
+    """
+    Lists foods in name order, optionally restricted to names starting with prefix.
+    after: keyset cursor, only names strictly greater than it are returned.
+    Uses range scans on the unique name index of each tier. First pages are served from a small LRU.
+    Returns: list of dicts {'name', 'calories', 'allergens'}.
+    """
+    prefix = prefix.strip().upper()
+    cache_key = (_current_property.get(), prefix, limit)
+    if not after:
+        with _prefix_cache_lock:
+            cached = _prefix_cache.get(cache_key)
+            if cached and time.monotonic() - cached[0] < PREFIX_CACHE_TTL:
+                _prefix_cache.move_to_end(cache_key)
+                return cached[1]
+
+    rows = _merged_page(after, limit, prefix)
+
+    if not after and PREFIX_CACHE_SIZE > 0:
+        with _prefix_cache_lock:
+            _prefix_cache[cache_key] = (time.monotonic(), rows)
+            _prefix_cache.move_to_end(cache_key)
+            while len(_prefix_cache) > PREFIX_CACHE_SIZE:
+                _prefix_cache.popitem(last=False)
+    return rows
+
+# --- Saved Menus ---
+
+def save_menu(name, outlet, dishes, schedule):
+    """
+    Creates or replaces a saved menu. dishes: ordered list of food names.
+    The menu is flagged stale so the scheduler renders it again.
+    """
+    conn = get_db_connection()
+    try:
+        with conn:
+            conn.execute('''
+                INSERT INTO saved_menus (name, outlet, schedule, stale) VALUES (?, ?, ?, 1)
+                ON CONFLICT(name) DO UPDATE SET outlet = excluded.outlet, schedule = excluded.schedule, stale = 1
+            ''', (name, outlet, schedule))
+            menu_id = conn.execute('SELECT id FROM saved_menus WHERE name = ?', (name,)).fetchone()['id']
+            conn.execute('DELETE FROM saved_menu_dishes WHERE menu_id = ?', (menu_id,))
+            conn.executemany('INSERT INTO saved_menu_dishes (menu_id, position, dish) VALUES (?, ?, ?)',
+                             [(menu_id, i, dish) for i, dish in enumerate(dishes)])
     finally:
         conn.close()
 
+def _menu_dict(conn, row):
+    dishes = conn.execute('SELECT dish FROM saved_menu_dishes WHERE menu_id = ? ORDER BY position',
+                          (row['id'],)).fetchall()
+    menu = dict(row)
+    menu['dishes'] = [d['dish'] for d in dishes]
+    menu['missing'] = menu['missing'].split(',') if menu['missing'] else []
+    menu['stale'] = bool(menu['stale'])
+    return menu
+
+def get_menu(name):
+    """Returns: the saved menu as a dict (with an ordered 'dishes' list), or None."""
+    conn = get_db_connection()
+    try:
+        row = conn.execute('SELECT * FROM saved_menus WHERE name = ?', (name,)).fetchone()
+        return _menu_dict(conn, row) if row else None
+    finally:
+        conn.close()
+
+def list_menus():
+    conn = get_db_connection()
+    try:
+        rows = conn.execute('SELECT * FROM saved_menus ORDER BY name').fetchall()
+        return [_menu_dict(conn, row) for row in rows]
+    finally:
+        conn.close()
+
+def delete_menu(name):
+    conn = get_db_connection()
+    try:
+        with conn:
+            row = conn.execute('SELECT id FROM saved_menus WHERE name = ?', (name,)).fetchone()
+            if not row:
+                return False
+            conn.execute('DELETE FROM saved_menu_dishes WHERE menu_id = ?', (row['id'],))
+            conn.execute('DELETE FROM saved_menus WHERE id = ?', (row['id'],))
+            return True
+    finally:
+        conn.close()
+
+def set_menu_rendered(name, rendered_file, rendered_at, missing):
+    conn = get_db_connection()
+    try:
+        with conn:
+            conn.execute('''
+                UPDATE saved_menus SET rendered_file = ?, rendered_at = ?, missing = ?, stale = 0 WHERE name = ?
+            ''', (rendered_file, rendered_at, ",".join(missing), name))
+    finally:
+        conn.close()
+
+def mark_menus_stale(dish_names, conn=None):
+    """Flags every saved menu containing one of dish_names for re-rendering."""
+    if not dish_names:
+        return
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
+    try:
+        dish_names = list(dict.fromkeys(dish_names))
+        for i in range(0, len(dish_names), 500):
+            chunk = dish_names[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            conn.execute(f'''
+                UPDATE saved_menus SET stale = 1 WHERE stale = 0 AND id IN
+                    (SELECT menu_id FROM saved_menu_dishes WHERE dish IN ({placeholders}))
+            ''', chunk)
+        if own_conn:
+            conn.commit()
+    except sqlite3.OperationalError as e:
+        # Databases created before saved menus existed have no menu tables yet
+        print(f"Could not flag saved menus: {e}")
+    finally:
+        if own_conn:
+            conn.close()
+
+def _mark_property_menus_stale(dish_names):
+    """A change in the global tier can affect menus of every property that uses the dish."""
+    if not dish_names or _current_property.get():
+        return
+    for key in list_properties():
+        with use_property(key):
+            mark_menus_stale(dish_names)
+
 if __name__ == '__main__':
     init_db()
@@ -1,30 +1,52 @@
+import csv
+import io
+import multiprocessing
 import openpyxl
 import os
 import shutil
+import tempfile
+import threading
+import zipfile
 import pandas as pd
+from openpyxl.utils import get_column_letter
+from openpyxl.utils.cell import range_boundaries
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
 from datetime import datetime
-from database import get_food
+from database import get_foods, get_menu, set_menu_rendered, iter_foods
+
+# Column headers of the bulk upload format (also used for exports)
+BULK_COLUMNS = ['Food Name', 'Calories', 'Allergens']
 
 TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), 'data', 'Mastersheet_TAJ_CAL27.xlsx')
-OUTPUT_DIR = os.path.join(os.path.dirname(__file__), 'data', 'output')
+OUTPUT_DIR = os.getenv('OUTPUT_DIR', os.path.join(os.path.dirname(__file__), 'data', 'output'))
 
 if not os.path.exists(OUTPUT_DIR):
     os.makedirs(OUTPUT_DIR)
 
-def process_bulk_upload_excel(file_path):
+def process_bulk_upload_excel(file_path, rejected=None):
     """
-    Reads an uploaded Excel file.
+    Reads an uploaded Excel file (or a .csv export) and validates it column by column.
     Expected Columns: "Food Name", "Calories", "Allergens"
+    Allergen spellings are normalised through ALLERGEN_ALIASES (e.g. "Soya" -> "Soy").
+    rejected: Optional list; invalid rows are appended as
+              {'row': <excel row>, 'name': '...', 'calories': ..., 'allergens': '...', 'reason': '...'}
+              and left out of the result. Without it, an invalid row raises ValueError.
     Returns: list of dicts [{'name': '...', 'calories': ..., 'allergens': [...]}]
     """
     try:
-        df = pd.read_excel(file_path)
+        if str(file_path).lower().endswith('.csv'):
+            df = pd.read_csv(file_path)
+        else:
+            df = pd.read_excel(file_path)
     except Exception as e:
         print(f"Error reading Excel: {e}")
         return []
 
     # clean column names (strip spaces, lower case for matching)
-    df.columns = [c.strip().lower() for c in df.columns]
+    df.columns = [str(c).strip().lower() for c in df.columns]
     
     # Map expected columns
     # We expect "food name", "calories", "allergens"
@@ -37,162 +59,788 @@ def process_bulk_upload_excel(file_path):
         print("Required columns (Food Name, Calories) not found")
         return []
 
-    items = []
-    for _, row in df.iterrows():
-        name = str(row[col_name]).strip()
-        if not name or name.lower() == 'nan':
-            continue
-            
-        calories = row[col_cal]
-        # Handle NaN calories
-        if pd.isna(calories):
-            calories = 0
-            
-        allergens_str = str(row[col_alg]) if col_alg and not pd.isna(row[col_alg]) else ""
-        # Split allergens by comma
-        allergens = [a.strip() for a in allergens_str.split(',') if a.strip()]
-        
-        items.append({
-            'name': name.upper(), # Enforce Uppercase
-            'calories': int(calories),
-            'allergens': allergens
+    df = df.reset_index(drop=True)
+
+    # Names: rows without a name are skipped silently, as before
+    names = df[col_name].astype(str).str.strip()
+    has_name = df[col_name].notna() & names.ne('') & names.str.lower().ne('nan')
+    df, names = df[has_name], names[has_name].str.upper() # Enforce Uppercase
+    errors = pd.Series('', index=df.index)
+
+    # Calories: blank means 0; text and negative numbers are errors
+    raw_calories = df[col_cal]
+    calories = pd.to_numeric(raw_calories, errors='coerce')
+    blank_calories = raw_calories.isna() | raw_calories.astype(str).str.strip().eq('')
+    errors = errors.where(~(calories.isna() & ~blank_calories), errors + 'Invalid calories; ')
+    errors = errors.where(~(calories < 0), errors + 'Negative calories; ')
+    calories = calories.fillna(0).clip(lower=0).astype(int)
+
+    # Allergens: one row per (sheet row, allergen) so the alias lookup runs once over the whole column
+    if col_alg:
+        raw_allergens = df[col_alg].fillna('').astype(str)
+        exploded = raw_allergens.str.split(',').explode().str.strip()
+        exploded = exploded[exploded.ne('')]
+        canonical = exploded.str.lower().map(ALLERGEN_LOOKUP)
+
+        # Collect per row in plain dicts; groupby().agg(list) or .at[] make a pandas call per row
+        unknown, known = {}, {}
+        for idx, text, name in zip(exploded.index, exploded.tolist(), canonical.tolist()):
+            if not isinstance(name, str):
+                unknown.setdefault(idx, []).append(text)
+            elif name not in known.setdefault(idx, []):
+                known[idx].append(name)
+        if unknown:
+            unknown = pd.Series({idx: ', '.join(texts) for idx, texts in unknown.items()})
+            errors.loc[unknown.index] += 'Unknown allergen(s): ' + unknown + '; '
+        allergen_lists = pd.Series([known.get(idx, []) for idx in df.index], index=df.index, dtype=object)
+    else:
+        raw_allergens = pd.Series('', index=df.index)
+        allergen_lists = pd.Series([[] for _ in range(len(df))], index=df.index, dtype=object)
+
+    invalid = errors.ne('')
+    if invalid.any():
+        bad = pd.DataFrame({
+            'row': df.index[invalid] + 2, # index is 0-based below the header row
+            'name': names[invalid],
+            'calories': raw_calories[invalid].astype(str).replace('nan', ''),
+            'allergens': raw_allergens[invalid],
+            'reason': errors[invalid].str.rstrip('; '),
         })
-        
-    return items
+        if rejected is None:
+            first = bad.iloc[0]
+            raise ValueError(f"Row {first['row']} ({first['name']}): {first['reason']}")
+        rejected.extend(bad.to_dict('records'))
+
+    valid = ~invalid
+    return [
+        {'name': name, 'calories': cal, 'allergens': allergens}
+        for name, cal, allergens in zip(names[valid], calories[valid].tolist(), allergen_lists[valid])
+    ]
 
-def generate_excel(food_names, custom_data=None):
+def write_rejection_report(rejected):
     """
-    Generates an Excel file filled with food data.
-    food_names: List of strings (food names).
-    custom_data: Optional dictionary {'NAME': {'calories': 123, 'allergens': '...'}} to bypass DB.
-    Returns: Path to the generated file, and a list of missing foods.
+    Writes the rows rejected by process_bulk_upload_excel to an Excel report in OUTPUT_DIR.
+    Returns: Path to the report.
     """
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_file = os.path.join(OUTPUT_DIR, f"Buffet_Tags_{timestamp}.xlsx")
-    
-    # Copy template
-    shutil.copy(TEMPLATE_PATH, output_file)
-    
-    wb = openpyxl.load_workbook(output_file)
-    ws = wb.active
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    output_file = os.path.join(OUTPUT_DIR, f"Upload_Errors_{timestamp}.xlsx")
 
-    # Prepare data to fill
-    missing_foods = []
-    
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet('Errors')
+    ws.append(['Row', 'Food Name', 'Calories', 'Allergens', 'Errors'])
+    for r in rejected:
+        ws.append([r['row'], r['name'], r.get('calories', ''), r.get('allergens', ''), r['reason']])
+    wb.save(output_file)
+    return output_file
+
+# Column Mappings (1-based index)
+# Food Name: D (4)
+# Calories: W (23)
+# Allergens: X (24) to AK (37)
+NAME_COL = 4
+CALORIES_COL = 23
+
+# Map DB allergen strings to Column Indices
+ALLERGEN_COLUMNS = {
+    'Crustaceans': 24, # X
+    'Molluscs': 25,    # Y
+    'Fish': 26,        # Z
+    'Soy': 27,         # AA - Renamed from Soya
+    'Gluten': 28,      # AB
+    'Mustard': 29,     # AC
+    'Sesame': 30,      # AD
+    'Celery': 31,      # AE
+    'Eggs': 32,        # AF
+    'Milk': 33,        # AG
+    'Peanuts': 34,     # AH
+    'Nuts': 35,        # AI
+    'Sulphite': 36,    # AJ
+    'Lupin': 37        # AK
+}
+
+# Accepted spellings (lower case) of each allergen, on top of the canonical names above
+ALLERGEN_ALIASES = {
+    'Crustaceans': ['crustacean', 'shellfish'],
+    'Molluscs': ['mollusc', 'moluscs', 'mollusks', 'mollusk'],
+    'Fish': [],
+    'Soy': ['soya', 'soybean', 'soybeans', 'soy beans', 'soya beans'],
+    'Gluten': ['cereals containing gluten', 'wheat'],
+    'Mustard': [],
+    'Sesame': ['sesame seeds', 'sesame seed'],
+    'Celery': ['celeriac'],
+    'Eggs': ['egg'],
+    'Milk': ['dairy', 'lactose'],
+    'Peanuts': ['peanut', 'groundnut', 'groundnuts'],
+    'Nuts': ['nut', 'tree nuts', 'tree nut'],
+    'Sulphite': ['sulphites', 'sulfite', 'sulfites', 'sulphur dioxide', 'sulfur dioxide', 'sulphuite'],
+    'Lupin': ['lupine', 'lupins']
+}
+ALLERGEN_LOOKUP = {alias: name for name, aliases in ALLERGEN_ALIASES.items() for alias in aliases + [name.lower()]}
+
+def canonical_allergen(text):
+    """Returns: the canonical allergen name for any accepted spelling, or None."""
+    return ALLERGEN_LOOKUP.get(str(text).strip().lower())
+
+# Every column a tag row writes to: D, W, X..AK
+ROW_COLUMNS = [NAME_COL, CALORIES_COL] + list(range(24, 38))
+
+# Start row (assuming header is row 1), Header + 50 items
+START_ROW = 2
+MAX_ITEMS = 50
+
+# Last rendered workbook per session (web session / bot user), least recently used first.
+# Lets a small edit in the verify step re-patch only the changed rows.
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', '32'))
+_render_cache = OrderedDict()
+_render_cache_lock = threading.Lock()
+
+def _row_values(clean_name, food_data, dropped=None):
+    """
+    Computes the cell values a tag row should hold.
+    dropped: Optional list that collects allergen values with no column (they are not written).
+    Returns: tuple aligned with ROW_COLUMNS.
+    """
+    # Clear Calories and Allergens for this row strictly (do NOT touch red cols H, I)
+    values = {col: "" for col in ROW_COLUMNS}
+    values[NAME_COL] = clean_name
+
+    if food_data:
+        values[CALORIES_COL] = food_data['calories']
+
+        # food_data['allergens'] might be a list (from custom_data) or string (from DB)
+        raw_allergens = food_data['allergens']
+        if isinstance(raw_allergens, list):
+            db_allergens = [str(a).strip() for a in raw_allergens]
+        elif isinstance(raw_allergens, str) and raw_allergens:
+            db_allergens = [a.strip() for a in raw_allergens.split(',')]
+        else:
+            db_allergens = []
+
+        for allergen in db_allergens:
+            # DB has "Fish", "Sesame seeds" etc from checkbox, so map known spellings first
+            name = canonical_allergen(allergen)
+            if name:
+                values[ALLERGEN_COLUMNS[name]] = "yes"
+            elif allergen and dropped is not None:
+                dropped.append(allergen)
+
+    return tuple(values[col] for col in ROW_COLUMNS)
+
+def _resolve_rows(food_names, custom_data, catalogue=None, dropped=None):
+    """
+    Resolves the first 50 names to row values.
+    catalogue: Optional pre-fetched {NAME: food data} used instead of querying the database.
+    dropped: Optional dict filled with {row index: allergen values that have no column}.
+    Returns: list of row value tuples (None for blank names, which leave the row untouched),
+             and a list of missing foods.
+    """
     # Limit to first 50 items
-    items_to_process = food_names[:50]
-    
-    # Start row (assuming header is row 1)
-    start_row = 2
-    max_row = 51 # Header + 50 items
-    
-    for i, name in enumerate(items_to_process):
-        current_row = start_row + i
-        clean_name = name.strip().upper()
+    items_to_process = [name.strip().upper() for name in food_names[:MAX_ITEMS]]
+
+    # One query for everything not supplied by custom_data
+    lookup = [n for n in items_to_process if n and not (custom_data and n in custom_data)]
+    if catalogue is not None:
+        db_rows = catalogue
+    else:
+        db_rows = get_foods(lookup) if lookup else {}
+
+    rows = []
+    missing_foods = []
+    for clean_name in items_to_process:
         if not clean_name:
+            rows.append(None)
             continue
-            
+
         if custom_data and clean_name in custom_data:
             food_data = custom_data[clean_name]
         else:
-            food_data = get_food(clean_name)
-        
-        # Column Mappings (1-based index)
-        # Food Name: D (4)
-        # Calories: W (23)
-        # Allergens: X (24) to AK (37)
-        
-        # Update Name
-        ws.cell(row=current_row, column=4, value=clean_name)
-        
-        # Clear Calories and Allergens for this row strictly (do NOT touch red cols H, I)
-        ws.cell(row=current_row, column=23, value="") # Clear W (Calories)
-        for col in range(24, 38): # X to AK
-             ws.cell(row=current_row, column=col, value="")
-        
-        if food_data:
-            # Fill Calories
-            ws.cell(row=current_row, column=23, value=food_data['calories'])
-            
-            # Allergen Mapping
-            # Map DB allergen strings to Column Indices
-            allergen_map = {
-                'Crustaceans': 24, # X
-                'Molluscs': 25,    # Y
-                'Fish': 26,        # Z
-                'Soy': 27,         # AA - Renamed from Soya
-                'Gluten': 28,      # AB
-                'Mustard': 29,     # AC
-                'Sesame': 30,      # AD
-                'Celery': 31,      # AE
-                'Eggs': 32,        # AF
-                'Milk': 33,        # AG
-                'Peanuts': 34,     # AH
-                'Nuts': 35,        # AI
-                'Sulphite': 36,    # AJ
-                'Lupin': 37        # AK
-            }
-            
-            # food_data['allergens'] might be a list (from custom_data) or string (from DB)
-            raw_allergens = food_data['allergens']
-            if isinstance(raw_allergens, list):
-                db_allergens = [str(a).strip() for a in raw_allergens]
-            elif isinstance(raw_allergens, str) and raw_allergens:
-                db_allergens = [a.strip() for a in raw_allergens.split(',')]
-            else:
-                db_allergens = []
-            
-            for allergen in db_allergens:
-                # We need to match somewhat loosely or exactly?
-                # DB has "Fish", "Sesame seeds" etc from checkbox.
-                # Let's try exact match from map keys
-                if allergen in allergen_map:
-                    col_idx = allergen_map[allergen]
-                    ws.cell(row=current_row, column=col_idx, value="yes")
-                else:
-                    # Fallback check?
-                    pass
+            food_data = db_rows.get(clean_name)
 
-        else:
+        if not food_data:
             missing_foods.append(clean_name)
-    
+        row_dropped = [] if dropped is not None else None
+        rows.append(_row_values(clean_name, food_data, row_dropped))
+        if row_dropped:
+            dropped[len(rows) - 1] = row_dropped
+
+    return rows, missing_foods
+
+def preview_rows(food_names, custom_data=None):
+    """
+    Computes the rows generate_excel would write, without opening the template.
+    Returns: {'columns': [{'column', 'field'}] aligned with each row's 'cells',
+              'rows': [{'row', 'name', 'calories', 'allergens', 'cells', 'dropped', 'missing'}],
+              'missing': names not found, 'truncated': names past MAX_ITEMS, 'total': names given}
+    Blank names are left out; their sheet rows stay untouched.
+    """
+    dropped = {}
+    rows, missing_foods = _resolve_rows(food_names, custom_data, dropped=dropped)
+    missing = set(missing_foods)
+    fields = {NAME_COL: 'Food Name', CALORIES_COL: 'Calories'}
+    fields.update({col: name for name, col in ALLERGEN_COLUMNS.items()})
+
+    preview = []
+    for i, values in enumerate(rows):
+        if values is None:
+            continue
+        cells = dict(zip(ROW_COLUMNS, values))
+        preview.append({
+            'row': START_ROW + i,
+            'name': cells[NAME_COL],
+            'calories': cells[CALORIES_COL],
+            'allergens': [fields[col] for col in ROW_COLUMNS if cells[col] == "yes"],
+            'cells': list(values),
+            'dropped': dropped.get(i, []),
+            'missing': cells[NAME_COL] in missing
+        })
+
+    return {
+        'columns': [{'column': get_column_letter(col), 'field': fields[col]} for col in ROW_COLUMNS],
+        'rows': preview,
+        'missing': missing_foods,
+        'truncated': [name.strip().upper() for name in food_names[MAX_ITEMS:] if name.strip()],
+        'total': len(food_names)
+    }
+
+def _write_row(ws, row, values):
+    for col, value in zip(ROW_COLUMNS, values):
+        # Assign directly: ws.cell(value=None) would leave the old value in place
+        ws.cell(row=row, column=col).value = value
+
+def _render_full(output_file, rows):
+    """Copies the template and fills every row. Returns the cache entry for the result."""
+    # Copy template
+    shutil.copy(TEMPLATE_PATH, output_file)
+
+    wb = openpyxl.load_workbook(output_file)
+    ws = wb.active
+
+    # Snapshot the template cells we may overwrite, to restore rows dropped by a later patch
+    template_rows = [
+        tuple(ws.cell(row=START_ROW + i, column=col).value for col in ROW_COLUMNS)
+        for i in range(MAX_ITEMS)
+    ]
+
+    for i, values in enumerate(rows):
+        if values is not None:
+            _write_row(ws, START_ROW + i, values)
+
     # Force delete rows logic DISABLED by user request (2026-02-17)
     # The user reported 999 rows being processed. We must clean up aggressively.
-    
+
     # last_filled_row = start_row + len(items_to_process) - 1
     # start_delete = last_filled_row + 1
     # target_end_row = 1000 # Cover user's reported 999 range + 1
-    
+
     # # Calculate amount to delete.
     # # Even if openpyxl thinks max_row is small, we force delete up to 1000.
     # amount_to_delete = target_end_row - start_delete + 1
-    
+
     # if amount_to_delete > 0:
     #     ws.delete_rows(start_delete, amount_to_delete)
 
     wb.save(output_file)
+    return {
+        'wb': wb,
+        'template_rows': template_rows,
+        'rows': rows + [None] * (MAX_ITEMS - len(rows)),
+        'lock': threading.Lock(),
+    }
+
+def _render_patch(output_file, entry, rows):
+    """Rewrites only the rows that differ from the cached render, then saves."""
+    ws = entry['wb'].active
+    rows = rows + [None] * (MAX_ITEMS - len(rows))
+
+    for i, (old, new) in enumerate(zip(entry['rows'], rows)):
+        if old == new:
+            continue
+        # A row that is no longer rendered goes back to its template state
+        _write_row(ws, START_ROW + i, new if new is not None else entry['template_rows'][i])
+
+    entry['rows'] = rows
+    entry['wb'].save(output_file)
+
+def generate_excel(food_names, custom_data=None, session_key=None):
+    """
+    Generates an Excel file filled with food data.
+    food_names: List of strings (food names).
+    custom_data: Optional dictionary {'NAME': {'calories': 123, 'allergens': '...'}} to bypass DB.
+    session_key: Optional id of the user session. Re-renders for the same session patch
+                 the previously rendered workbook instead of starting from the template.
+    Returns: Path to the generated file, and a list of missing foods.
+    """
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    output_file = os.path.join(OUTPUT_DIR, f"Buffet_Tags_{timestamp}.xlsx")
+
+    rows, missing_foods = _resolve_rows(food_names, custom_data)
+    _render(output_file, rows, session_key)
     return output_file, missing_foods
 
-def extract_names_from_excel(file_path):
+def _render(output_file, rows, session_key):
+    """Renders rows to output_file, patching the session's last workbook when there is one."""
+    entry = None
+    if session_key is not None:
+        with _render_cache_lock:
+            entry = _render_cache.get(session_key)
+            if entry:
+                _render_cache.move_to_end(session_key)
+
+    if entry:
+        with entry['lock']:
+            _render_patch(output_file, entry, rows)
+        return
+
+    entry = _render_full(output_file, rows)
+    if session_key is not None and RENDER_CACHE_SIZE > 0:
+        with _render_cache_lock:
+            _render_cache[session_key] = entry
+            _render_cache.move_to_end(session_key)
+            while len(_render_cache) > RENDER_CACHE_SIZE:
+                _render_cache.popitem(last=False)
+
+def render_menu_file(output_file, food_names, catalogue, session_key=None):
+    """
+    Renders food_names into output_file from a pre-fetched catalogue ({NAME: food data},
+    e.g. one get_foods() call shared by many menus) without touching the database.
+    session_key: As for generate_excel; a batch reusing one key patches its previous
+                 workbook instead of reloading the template for every menu.
+    Returns: list of missing foods.
+    """
+    rows, missing_foods = _resolve_rows(food_names, None, catalogue=catalogue)
+    _render(output_file, rows, session_key)
+    return missing_foods
+
+def render_saved_menu(menu):
+    """
+    Renders a saved menu (dict from database.get_menu) and records the result.
+    Missing dishes are re-checked against the catalogue on every render, and the
+    file of the previous render is removed, so each menu keeps one file in OUTPUT_DIR.
+    Returns: Path to the generated file, and a list of missing foods.
+    """
+    output_file, missing_foods = generate_excel(menu['dishes'])
+    set_menu_rendered(menu['name'], os.path.basename(output_file),
+                      datetime.now().isoformat(timespec='seconds'), missing_foods)
+    remove_rendered_file(menu)
+    return output_file, missing_foods
+
+def remove_rendered_file(menu):
+    """Removes the file a saved menu was last rendered to, if it is still there."""
+    if menu.get('rendered_file'):
+        try:
+            os.remove(os.path.join(OUTPUT_DIR, os.path.basename(menu['rendered_file'])))
+        except OSError:
+            pass
+
+def get_saved_menu_file(name, limiter=nullcontext):
+    """
+    Returns the pre-rendered file of a saved menu, rendering it first only if it is
+    stale or the file is gone.
+    limiter: Context manager factory entered around a render only (e.g. admission.admit).
+    Returns: (path, missing foods), or (None, []) if the menu does not exist.
+    """
+    menu = get_menu(name)
+    if not menu:
+        return None, []
+
+    if menu['rendered_file'] and not menu['stale']:
+        path = os.path.join(OUTPUT_DIR, menu['rendered_file'])
+        if os.path.exists(path):
+            return path, menu['missing']
+
+    with limiter():
+        return render_saved_menu(menu)
+
+def export_catalogue_csv(batch_size=1000):
+    """
+    Streams the catalogue as CSV in the bulk upload format.
+    Yields: CSV text chunks, one per database batch.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(BULK_COLUMNS)
+    for rows in iter_foods(batch_size):
+        for row in rows:
+            writer.writerow([row['name'], row['calories'], row['allergens'] or ''])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # Header only, for an empty catalogue
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def export_catalogue_xlsx(batch_size=1000):
+    """
+    Writes the catalogue to a temporary .xlsx in the bulk upload format using a
+    write-only workbook, so rows are streamed to disk instead of held in memory.
+    Returns: Path to the file (the caller removes it).
+    """
+    fd, output_file = tempfile.mkstemp(suffix='.xlsx', prefix='catalogue_export_')
+    os.close(fd)
+
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet('Catalogue')
+    ws.append(BULK_COLUMNS)
+    for rows in iter_foods(batch_size):
+        for row in rows:
+            ws.append([row['name'], row['calories'], row['allergens'] or ''])
+    wb.save(output_file)
+    return output_file
+
+# One bit per allergen, in sheet column order (Crustaceans = bit 0 ... Lupin = bit 13)
+ALLERGEN_BITS = {name: 1 << i for i, name in enumerate(sorted(ALLERGEN_COLUMNS, key=ALLERGEN_COLUMNS.get))}
+
+def allergen_mask(raw_allergens):
+    """
+    raw_allergens: list or comma-separated string, in any accepted spelling.
+    Returns: (bitmask of ALLERGEN_BITS, values that name no allergen).
+    """
+    if isinstance(raw_allergens, str):
+        raw_allergens = raw_allergens.split(',')
+    mask = 0
+    unknown = []
+    for value in raw_allergens or []:
+        value = str(value).strip()
+        if not value:
+            continue
+        name = canonical_allergen(value)
+        if name:
+            mask |= ALLERGEN_BITS[name]
+        else:
+            unknown.append(value)
+    return mask, unknown
+
+def allergen_summary(food_names):
+    """
+    Allergen overview of a menu or any list of dishes (no 50-row limit).
+    All dishes are fetched in one get_foods call; each becomes a bitmask, and the per-allergen
+    aggregates are computed once per distinct mask rather than once per dish.
+    Returns: {'allergens': names in column order,
+              'dishes': [{'name', 'calories', 'allergens', 'mask'}] (the dish x allergen matrix),
+              'counts': {allergen: dishes containing it}, 'dishes_by_allergen': {allergen: [names]},
+              'allergen_free': [names], 'missing': [names], 'unrecognised': {name: [values]},
+              'total': distinct dishes asked for}
+    """
+    names = list(dict.fromkeys(n.strip().upper() for n in food_names if n and n.strip()))
+    rows = get_foods(names) if names else {}
+
+    dishes = []
+    by_mask = {}
+    unrecognised = {}
+    for name in names:
+        row = rows.get(name)
+        if not row:
+            continue
+        mask, unknown = allergen_mask(row['allergens'])
+        if unknown:
+            unrecognised[name] = unknown
+        dishes.append({
+            'name': name,
+            'calories': row['calories'],
+            'allergens': [a for a, bit in ALLERGEN_BITS.items() if mask & bit],
+            'mask': mask
+        })
+        by_mask.setdefault(mask, []).append(name)
+
+    dishes_by_allergen = {}
+    for allergen, bit in ALLERGEN_BITS.items():
+        dishes_by_allergen[allergen] = [n for mask, group in by_mask.items() if mask & bit for n in group]
+
+    return {
+        'allergens': list(ALLERGEN_BITS),
+        'dishes': dishes,
+        'counts': {a: len(found) for a, found in dishes_by_allergen.items()},
+        'dishes_by_allergen': dishes_by_allergen,
+        'allergen_free': by_mask.get(0, []),
+        'missing': [n for n in names if n not in rows],
+        'unrecognised': unrecognised,
+        'total': len(names)
+    }
+
+def write_allergen_summary(summary, title=''):
+    """
+    Writes an allergen_summary result as a compact workbook in OUTPUT_DIR: an overview sheet
+    (count and dishes per allergen) and a matrix sheet (one row per dish, "yes" per allergen).
+    Returns: Path to the workbook.
+    """
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    output_file = os.path.join(OUTPUT_DIR, f"Allergen_Summary_{timestamp}.xlsx")
+
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet('Summary')
+    if title:
+        ws.append([title])
+    ws.append(['Dishes', len(summary['dishes'])])
+    ws.append(['Allergen-free', len(summary['allergen_free']), ", ".join(summary['allergen_free'])])
+    if summary['missing']:
+        ws.append(['Not in catalogue', len(summary['missing']), ", ".join(summary['missing'])])
+    ws.append([])
+    ws.append(['Allergen', 'Dishes', 'Dish Names'])
+    for allergen in summary['allergens']:
+        ws.append([allergen, summary['counts'][allergen], ", ".join(summary['dishes_by_allergen'][allergen])])
+
+    ws = wb.create_sheet('Matrix')
+    ws.append(['Food Name', 'Calories'] + summary['allergens'])
+    for dish in summary['dishes']:
+        ws.append([dish['name'], dish['calories']] +
+                  ["yes" if dish['mask'] & ALLERGEN_BITS[a] else "" for a in summary['allergens']])
+    wb.save(output_file)
+    return output_file
+
+# Cells read by name extraction, overridable per call (e.g. "D2:D80" or "B5:C40")
+EXTRACT_RANGE = os.getenv('EXTRACT_RANGE', 'D2:D60')
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', str(os.cpu_count() or 1)))
+# Fewer workbooks than this are parsed in the calling thread; the pool only pays off for batches
+EXTRACT_POOL_MIN_FILES = int(os.getenv('EXTRACT_POOL_MIN_FILES', '4'))
+# Zip archive limits, checked against the sizes in the archive's directory before anything is inflated
+ZIP_MAX_MEMBERS = int(os.getenv('ZIP_MAX_MEMBERS', '500'))
+ZIP_MAX_MEMBER_BYTES = int(os.getenv('ZIP_MAX_MEMBER_BYTES', str(50 * 1024 * 1024)))
+ZIP_MAX_TOTAL_BYTES = int(os.getenv('ZIP_MAX_TOTAL_BYTES', str(200 * 1024 * 1024)))
+
+class ArchiveTooLarge(Exception):
+    """Raised for a zip archive whose workbooks exceed the ZIP_MAX_* limits."""
+
+# One extraction pool per process, shared by every request and started on first use.
+# Spawned rather than forked: forking a threaded server process can copy held locks.
+_extract_pool = None
+_extract_pool_lock = threading.Lock()
+
+def _get_extract_pool():
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is None:
+            _extract_pool = ProcessPoolExecutor(max_workers=max(1, EXTRACT_WORKERS),
+                                                mp_context=multiprocessing.get_context('spawn'))
+        return _extract_pool
+
+def _discard_extract_pool(pool):
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is pool:
+            _extract_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _names_in_sheet(ws, cell_range):
+    """Returns: non-empty cell values of cell_range in ws, in reading order."""
+    min_col, min_row, max_col, max_row = range_boundaries(cell_range)
+    names = []
+    for row in ws.iter_rows(min_row=min_row, max_row=max_row, min_col=min_col, max_col=max_col, values_only=True):
+        for value in row:
+            if value:
+                name = str(value).strip()
+                if name and name.lower() != 'nan':
+                    names.append(name)
+    return names
+
+def _extract_workbook(job):
+    """
+    Process pool task: reads one workbook in read-only (streaming) mode.
+    job: (file label, path or bytes, cell range, all_sheets)
+    Returns: list of (name, file label, sheet title); a workbook that cannot be read yields [].
+    """
+    label, source, cell_range, all_sheets = job
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    try:
+        wb = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    except Exception as e:
+        print(f"Extraction Error ({label}): {e}")
+        return []
+    try:
+        # Hidden sheets are usually lookups or old versions, not menus
+        sheets = [ws for ws in wb.worksheets if ws.sheet_state == 'visible'] if all_sheets else [wb.active]
+        return [(name, label, ws.title) for ws in sheets for name in _names_in_sheet(ws, cell_range)]
+    finally:
+        wb.close()
+
+def _check_archive(filename, members):
+    """Raises: ArchiveTooLarge when the members of a zip exceed the ZIP_MAX_* limits."""
+    if len(members) > ZIP_MAX_MEMBERS:
+        raise ArchiveTooLarge(f"{filename} holds {len(members)} workbooks; the limit is {ZIP_MAX_MEMBERS}.")
+    total = 0
+    for info in members:
+        if info.file_size > ZIP_MAX_MEMBER_BYTES:
+            raise ArchiveTooLarge(f"{filename}/{info.filename} unpacks to {info.file_size} bytes; "
+                                  f"the limit is {ZIP_MAX_MEMBER_BYTES}.")
+        total += info.file_size
+        if total > ZIP_MAX_TOTAL_BYTES:
+            raise ArchiveTooLarge(f"{filename} unpacks to more than {ZIP_MAX_TOTAL_BYTES} bytes.")
+
+def _expand_sources(sources):
+    """
+    Opens zip archives into their member workbooks.
+    sources: list of (filename, source) pairs; source is a path, bytes or a binary file-like object
+    Raises: ArchiveTooLarge for a zip over the ZIP_MAX_* limits.
+    Returns: list of (label, path or bytes) for every .xlsx to read.
+    """
+    jobs = []
+    for filename, source in sources:
+        if hasattr(source, 'read'):
+            path = getattr(source, 'name', None)
+            # A file on disk (e.g. a large bot upload spilled to a temp file) is passed on by
+            # path instead of being read into memory; paths and bytes both pickle into the pool
+            source = path if isinstance(path, str) and os.path.isabs(path) and os.path.isfile(path) else source.read()
+        if str(filename).lower().endswith('.zip'):
+            with zipfile.ZipFile(io.BytesIO(source) if isinstance(source, bytes) else source) as archive:
+                members = []
+                for info in archive.infolist():
+                    base = os.path.basename(info.filename)
+                    # Skip folders, macOS resource forks and Excel lock files
+                    if info.is_dir() or info.filename.startswith('__MACOSX/') or base.startswith('~$'):
+                        continue
+                    if base.lower().endswith('.xlsx'):
+                        members.append(info)
+                _check_archive(filename, members)
+                for info in members:
+                    # ZipFile never inflates a member past its declared file_size
+                    jobs.append((f"{filename}/{info.filename}", archive.read(info)))
+        elif str(filename).lower().endswith('.xlsx'):
+            jobs.append((filename, source))
+    return jobs
+
+def extract_names_batch(sources, cell_range=None, all_sheets=True, workers=None):
+    """
+    Extracts names from several workbooks and/or zip files of workbooks.
+    Workbooks are parsed in read-only streaming mode, across the process's extraction pool
+    from EXTRACT_POOL_MIN_FILES workbooks on.
+    sources: list of (filename, source) pairs; source is a path, bytes or a binary file-like
+             object. Files ending in .zip or .xlsx are read.
+    cell_range: Range to read on each sheet (default EXTRACT_RANGE).
+    all_sheets: Read every visible sheet, or only the active one.
+    workers: 1 parses in the calling thread; the pool's size is EXTRACT_WORKERS.
+    Raises: ValueError for an invalid cell_range, ArchiveTooLarge for an oversized zip.
+    Returns: (items, stats) where items is a list of
+             {'name': '...', 'sources': [{'file': '...', 'sheet': '...'}]} deduplicated
+             case-insensitively in first-seen order, and stats is {'files': n, 'sheets': n}.
+    """
+    cell_range = (cell_range or EXTRACT_RANGE).strip().upper()
+    range_boundaries(cell_range) # fail fast, before any worker starts
+
+    jobs = [(label, source, cell_range, all_sheets) for label, source in _expand_sources(sources)]
+    results = None
+    if (workers or EXTRACT_WORKERS) > 1 and len(jobs) >= EXTRACT_POOL_MIN_FILES:
+        pool = _get_extract_pool()
+        try:
+            results = list(pool.map(_extract_workbook, jobs))
+        except BrokenProcessPool as e:
+            # A worker died (e.g. killed for memory); start a fresh pool next time
+            print(f"Extraction pool broken, parsing in-thread: {e}")
+            _discard_extract_pool(pool)
+    if results is None:
+        results = [_extract_workbook(job) for job in jobs]
+
+    items = OrderedDict()
+    sheets = set()
+    for found in results:
+        for name, label, sheet in found:
+            sheets.add((label, sheet))
+            item = items.setdefault(name.upper(), {'name': name, 'sources': []})
+            source = {'file': label, 'sheet': sheet}
+            if source not in item['sources']:
+                item['sources'].append(source)
+    return list(items.values()), {'files': len(jobs), 'sheets': len(sheets)}
+
+def extract_names_from_excel(file_path, cell_range=None):
     """
     Extracts values from column D (rows 2 to 60) from the first sheet.
+    file_path: Path or binary file-like object (e.g. BytesIO).
+    cell_range: Range to read instead of EXTRACT_RANGE (D2:D60).
     Ignores empty values.
     Returns: list of strings (food names).
     """
     try:
-        wb = openpyxl.load_workbook(file_path, data_only=True)
-        ws = wb.active
-        
-        extracted_names = []
-        # Rows 2 to 60 (inclusive), Column 4 (D)
-        for row in range(2, 61):
-            cell_value = ws.cell(row=row, column=4).value
-            if cell_value:
-                name = str(cell_value).strip()
-                if name and name.lower() != 'nan':
-                    extracted_names.append(name)
-                    
-        return extracted_names
+        wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            return _names_in_sheet(wb.active, cell_range or EXTRACT_RANGE)
+        finally:
+            wb.close()
     except Exception as e:
         print(f"Extraction Error: {e}")
         return []
+
+# Filled mastersheets read back into the catalogue (import_mastersheets.py)
+LAST_TAG_COL = max(ROW_COLUMNS)
+
+def _flag_columns(header):
+    """
+    Maps allergen flag columns from a sheet's header row (NAME_COL..LAST_TAG_COL values).
+    Returns: {column: allergen}. Headings are used when each of X-AK names a different
+             allergen (older sheets may order them differently), else ALLERGEN_COLUMNS.
+    """
+    standard = {col: name for name, col in ALLERGEN_COLUMNS.items()}
+    if len(header) <= LAST_TAG_COL - NAME_COL:
+        return standard
+    headings = {col: canonical_allergen(header[col - NAME_COL]) for col in standard}
+    if None not in headings.values() and len(set(headings.values())) == len(standard):
+        return headings
+    return standard
+
+def _harvest_calories(value):
+    """Returns: (calories, error). Blank cells and text that is not a whole number are errors."""
+    if value is None or str(value).strip() == "":
+        return None, "Missing calories"
+    try:
+        number = float(str(value).strip())
+    except ValueError:
+        return None, f"Invalid calories: {value}"
+    if number < 0 or number != int(number):
+        return None, f"Invalid calories: {value}"
+    return int(number), None
+
+def harvest_workbook(job):
+    """
+    Process pool task: decodes the tag rows of one filled mastersheet, read-only.
+    job: (file label, path or bytes)
+    Returns: (records, errors). records: {'name', 'calories', 'allergens', 'file', 'sheet', 'row'}
+             with allergens in column order. errors: {'name', 'file', 'sheet', 'row', 'reason'};
+             a workbook that cannot be read yields one error with row None.
+    """
+    label, source = job
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    records, errors = [], []
+    try:
+        wb = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    except Exception as e:
+        return records, [{'name': '', 'file': label, 'sheet': '', 'row': None, 'reason': f"Unreadable workbook: {e}"}]
+    try:
+        for ws in wb.worksheets:
+            if ws.sheet_state != 'visible':
+                continue
+            rows = ws.iter_rows(min_row=START_ROW - 1, min_col=NAME_COL, max_col=LAST_TAG_COL, values_only=True)
+            header = next(rows, ())
+            flags = _flag_columns(header)
+            for row_number, row in enumerate(rows, START_ROW):
+                name = str(row[0]).strip().upper() if row and row[0] is not None else ""
+                if not name or name == 'NAN':
+                    continue
+                where = {'name': name, 'file': label, 'sheet': ws.title, 'row': row_number}
+                calories, error = _harvest_calories(row[CALORIES_COL - NAME_COL])
+                if error:
+                    errors.append({**where, 'reason': error})
+                    continue
+                allergens = [flags[col] for col in sorted(flags)
+                             if str(row[col - NAME_COL] or "").strip().lower() == "yes"]
+                records.append({**where, 'calories': calories, 'allergens': allergens})
+    finally:
+        wb.close()
+    return records, errors
+
+def harvest_mastersheets(sources, workers=None):
+    """
+    Decodes many filled mastersheets in parallel across processes.
+    sources: list of (file label, path or bytes).
+    Returns: (records, errors) in the order of sources, then sheet and row.
+    """
+    workers = min(workers or EXTRACT_WORKERS, len(sources))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(harvest_workbook, sources, chunksize=max(1, len(sources) // (workers * 4))))
+    else:
+        results = [harvest_workbook(job) for job in sources]
+
+    records, errors = [], []
+    for found, failed in results:
+        records.extend(found)
+        errors.extend(failed)
+    return records, errors
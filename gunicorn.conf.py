@@ -0,0 +1,32 @@
+"""
+Gunicorn settings used by run_app.sh (gunicorn -c gunicorn.conf.py app:app).
+
+openpyxl and pandas leave workers holding memory they never give back, so workers
+are recycled instead of growing until the box swaps:
+- MEMORY_LIMIT_MB (memwatch.py, default 512): a worker whose RSS is over the limit
+  after a request finishes that request and exits; the arbiter starts a fresh one.
+- MAX_REQUESTS (default 1000, 0 = never) restarts every worker after that many
+  requests, with up to MAX_REQUESTS_JITTER more so they do not restart together.
+
+Database migrations (init_db) run once in the master before any worker starts.
+Gunicorn also loads this file by default when started from this directory, so
+loadtest.py and the other spawned test servers get the same hook.
+"""
+import os
+
+from memwatch import MEMORY_LIMIT_MB, rss_bytes, MB
+
+bind = os.getenv('BIND', '0.0.0.0:5050')
+workers = int(os.getenv('WEB_CONCURRENCY', '4')) # admission.py sizes its slots from the same variable
+max_requests = int(os.getenv('MAX_REQUESTS', '1000'))
+max_requests_jitter = int(os.getenv('MAX_REQUESTS_JITTER', '100'))
+
+def on_starting(server):
+    from database import init_db
+    init_db()
+
+def post_request(worker, req, environ, resp):
+    rss = rss_bytes()
+    if MEMORY_LIMIT_MB and rss > MEMORY_LIMIT_MB * MB:
+        worker.log.info("Worker %s is over %s MB (RSS %.0f MB), recycling", worker.pid, MEMORY_LIMIT_MB, rss / MB)
+        worker.alive = False
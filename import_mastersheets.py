@@ -0,0 +1,171 @@
+"""
+Catalogue import from already-filled mastersheets.
+
+Reads archived tag workbooks (names in D, calories in W, "yes" flags in X-AK) in
+read-only mode across a process pool, decodes the flags back into allergen lists and
+loads the dishes into the catalogue in one transaction. Directories are searched for
+--pattern and for .zip archives of workbooks.
+
+The same dish often appears in many sheets. When its values differ, the conflict is
+resolved by --conflicts:
+    latest  the most recent sheet wins (file modification time, or --order name)
+    report  the dish is held back; every version is listed in the report for review
+
+The report CSV lists conflicts and rejected rows (e.g. a dish with no calories).
+
+Examples:
+    # Add every dish the catalogue does not have yet
+    python import_mastersheets.py /mnt/archive --pattern "Mastersheet_TAJ_*.xlsx"
+
+    # See what would change without writing, holding back conflicting dishes
+    python import_mastersheets.py /mnt/archive/2023.zip --conflicts report --dry-run
+"""
+import argparse
+import csv
+import glob
+import os
+import sys
+import time
+import zipfile
+from collections import OrderedDict
+from datetime import datetime
+
+from database import init_db, reset_property, set_property, upsert_foods, use_property
+from excel_utils import harvest_mastersheets, OUTPUT_DIR
+
+
+def find_sources(paths, pattern):
+    """
+    Expands directories (matching `pattern`, plus .zip archives), globs and zip files.
+    Returns: list of (label, path or bytes, timestamp); zip members carry their archive date.
+    """
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            files.update(glob.glob(os.path.join(path, pattern)))
+            files.update(glob.glob(os.path.join(path, '*.zip')))
+        else:
+            files.update(p for p in glob.glob(path) if os.path.isfile(p))
+
+    sources = []
+    for path in sorted(files):
+        base = os.path.basename(path)
+        if base.startswith('~$'):
+            continue # Excel lock file
+        if not path.lower().endswith('.zip'):
+            sources.append((path, path, os.path.getmtime(path)))
+            continue
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                member = os.path.basename(info.filename)
+                if info.is_dir() or info.filename.startswith('__MACOSX/') or member.startswith('~$'):
+                    continue
+                if member.lower().endswith('.xlsx'):
+                    stamp = datetime(*info.date_time).timestamp()
+                    sources.append((f"{path}/{info.filename}", archive.read(info), stamp))
+    return sources
+
+
+def resolve(records, mode):
+    """
+    Picks one version per dish. records must be ordered oldest first.
+    Returns: (items to load, {name: [records]} of dishes whose versions differ, held-back names).
+    """
+    versions = OrderedDict()
+    for record in records:
+        versions.setdefault(record['name'], []).append(record)
+
+    items, conflicts, held = [], {}, []
+    for name, found in versions.items():
+        distinct = {(r['calories'], tuple(r['allergens'])) for r in found}
+        if len(distinct) > 1:
+            conflicts[name] = found
+            if mode == 'report':
+                held.append(name)
+                continue
+        latest = found[-1]
+        items.append({'name': name, 'calories': latest['calories'], 'allergens': latest['allergens']})
+    return items, conflicts, held
+
+
+def write_report(path, conflicts, held, errors):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Dish', 'Status', 'Calories', 'Allergens', 'File', 'Sheet', 'Row', 'Note'])
+        for name, found in conflicts.items():
+            for i, r in enumerate(found):
+                if name in held:
+                    status = 'held'
+                else:
+                    status = 'imported' if i == len(found) - 1 else 'older'
+                writer.writerow([name, status, r['calories'], ", ".join(r['allergens']), r['file'], r['sheet'], r['row'],
+                                 f"{len(found)} versions"])
+        for e in errors:
+            writer.writerow([e['name'], 'rejected', '', '', e['file'], e['sheet'], e['row'] or '', e['reason']])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import dish data from filled buffet tag mastersheets.")
+    parser.add_argument('paths', nargs='+', help="Workbooks, zip archives, directories or glob patterns")
+    parser.add_argument('--pattern', default='*.xlsx', help="Workbook pattern used inside directories")
+    parser.add_argument('--conflicts', choices=['latest', 'report'], default='latest',
+                        help="latest: newest sheet wins; report: hold conflicting dishes back")
+    parser.add_argument('--order', choices=['mtime', 'name'], default='mtime',
+                        help="What makes a sheet newer: modification time or file name (e.g. dated names)")
+    parser.add_argument('--update', action='store_true', help="Also overwrite dishes already in the catalogue")
+    parser.add_argument('--property', default='', help="Property catalogue to load into (default: global)")
+    parser.add_argument('--report', default='', help="Report CSV (default: <output dir>/mastersheet_import_<time>.csv)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Reader processes")
+    parser.add_argument('--dry-run', action='store_true', help="Decode and resolve only, write nothing to the catalogue")
+    args = parser.parse_args()
+
+    try:
+        # Fail before any work when the property has no catalogue
+        reset_property(set_property(args.property or None))
+    except ValueError as e:
+        print(e)
+        return 1
+
+    start = time.perf_counter()
+    sources = find_sources(args.paths, args.pattern)
+    if not sources:
+        print("No workbooks found.")
+        return 1
+
+    # Oldest first, so later rows of later sheets win
+    sources.sort(key=(lambda s: s[0]) if args.order == 'name' else (lambda s: (s[2], s[0])))
+    records, errors = harvest_mastersheets([(label, source) for label, source, _ in sources], workers=args.workers)
+    read_time = time.perf_counter() - start
+
+    items, conflicts, held = resolve(records, args.conflicts)
+    result = None
+    if not args.dry_run:
+        init_db()
+        with use_property(args.property or None):
+            result = upsert_foods(items, update_existing=args.update)
+
+    report_path = args.report
+    if conflicts or errors:
+        if not report_path:
+            os.makedirs(OUTPUT_DIR, exist_ok=True)
+            report_path = os.path.join(OUTPUT_DIR, f"mastersheet_import_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+        write_report(report_path, conflicts, held, errors)
+
+    print(f"Read {len(records)} rows of {len(sources)} workbooks in {read_time:.2f}s: "
+          f"{len(items) + len(held)} distinct dishes, {len(conflicts)} with conflicting values.")
+    if result:
+        print(f"Added {len(result['added'])}, updated {len(result['updated'])}, "
+              f"unchanged {len(result['unchanged'])}, already in catalogue {len(result['skipped'])}.")
+    else:
+        print(f"Dry run: {len(items)} dishes would be loaded.")
+    if held:
+        print(f"{len(held)} conflicting dishes held back.")
+    if errors:
+        print(f"{len(errors)} rows or files rejected.")
+    if conflicts or errors:
+        print(f"Report: {report_path}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
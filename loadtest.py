@@ -0,0 +1,263 @@
+"""
+Local load generator for the HTTP API.
+
+Drives /api/process, /api/get_details, /api/generate_custom and /download/<filename>
+the way the bot does (process -> get_details -> generate_custom -> download) with
+random menus drawn from the catalogue, and reports latency percentiles, throughput
+and error rates per endpoint.
+
+Examples:
+    # Against an app that is already running
+    python loadtest.py --url http://localhost:5050 --concurrency 8 --duration 30
+
+    # Spawn gunicorn on a synthetic database and compare worker/thread layouts
+    python loadtest.py --spawn --configs 4x1,2x4,4x4 --dishes 5000 --rate 20
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from database import DB_PATH
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+VALID_ALLERGENS = [
+    'Celery', 'Gluten', 'Crustaceans', 'Eggs', 'Fish', 'Lupin', 'Milk',
+    'Molluscs', 'Mustard', 'Nuts', 'Peanuts', 'Sesame', 'Soy', 'Sulphite'
+]
+
+ENDPOINTS = ['process', 'get_details', 'generate_custom', 'download']
+
+
+def build_synthetic_db(path, dishes):
+    """Creates a food_items database with `dishes` random rows. Returns the list of names."""
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS food_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            calories INTEGER,
+            allergens TEXT
+        )
+    ''')
+    rng = random.Random(42)
+    rows = []
+    for i in range(dishes):
+        allergens = rng.sample(VALID_ALLERGENS, rng.randint(0, 4))
+        rows.append((f"DISH {i:06d}", rng.randint(20, 900), ",".join(allergens)))
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO food_items (name, calories, allergens) VALUES (?, ?, ?)', rows)
+    conn.close()
+    return [r[0] for r in rows]
+
+
+def load_names(path):
+    conn = sqlite3.connect(path)
+    names = [r[0] for r in conn.execute('SELECT name FROM food_items')]
+    conn.close()
+    return names
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {e: [] for e in ENDPOINTS}
+        self.errors = {e: 0 for e in ENDPOINTS}
+
+    def record(self, endpoint, seconds, ok):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def timed(stats, endpoint, func, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        res = func(*args, **kwargs)
+        ok = res.status_code == 200
+    except requests.RequestException:
+        res, ok = None, False
+    stats.record(endpoint, time.perf_counter() - start, ok)
+    return res if ok else None
+
+
+def run_session(base_url, names, args, stats, rng):
+    """One user flow: validate a menu, fetch details, generate and download the file."""
+    http = requests.Session()
+    menu = rng.sample(names, min(len(names), rng.randint(args.min_items, args.max_items)))
+    if rng.random() < args.missing_ratio:
+        # Some lists carry an unknown dish and stop at the missing-item step
+        menu.append(f"UNKNOWN DISH {rng.randint(0, 10**6)}")
+
+    res = timed(stats, 'process', http.post, f"{base_url}/api/process", json={'foods': menu}, timeout=args.timeout)
+    if res is None or res.json().get('status') != 'complete':
+        return
+
+    res = timed(stats, 'get_details', http.post, f"{base_url}/api/get_details", json={'foods': menu}, timeout=args.timeout)
+    if res is None:
+        return
+
+    items = res.json()['data']
+    res = timed(stats, 'generate_custom', http.post, f"{base_url}/api/generate_custom", json={'foods': items}, timeout=args.timeout)
+    if res is None:
+        return
+
+    # Generated links carry the app's own host name; keep the path and use our base url
+    download_path = res.json()['download_url'].split('/download/', 1)[1]
+    timed(stats, 'download', http.get, f"{base_url}/download/{download_path}", timeout=args.timeout)
+
+
+def drive(base_url, names, args):
+    """Runs sessions for args.duration seconds at up to args.concurrency in flight. Returns (stats, elapsed)."""
+    stats = Stats()
+    rng_lock = threading.Lock()
+    rng = random.Random(args.seed)
+    deadline = time.perf_counter() + args.duration
+    interval = 1.0 / args.rate if args.rate else 0.0
+
+    def worker(worker_id):
+        with rng_lock:
+            local_rng = random.Random(rng.random())
+        next_start = time.perf_counter() + (interval * worker_id / max(1, args.concurrency))
+        while True:
+            if interval:
+                # Open-loop pacing: each worker takes an equal share of the target rate
+                delay = next_start - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                next_start += interval * args.concurrency
+            if time.perf_counter() >= deadline:
+                return
+            run_session(base_url, names, args, stats, local_rng)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(worker, range(args.concurrency)))
+    return stats, time.perf_counter() - start
+
+
+def report(label, stats, elapsed):
+    print(f"\n== {label} ({elapsed:.1f}s) ==")
+    print(f"{'endpoint':<16}{'count':>7}{'err%':>7}{'rps':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for endpoint in ENDPOINTS:
+        values = sorted(stats.latencies[endpoint])
+        count = len(values)
+        err = 100.0 * stats.errors[endpoint] / count if count else 0.0
+        print(f"{endpoint:<16}{count:>7}{err:>7.1f}{count / elapsed:>8.1f}"
+              f"{percentile(values, 50) * 1000:>9.1f}{percentile(values, 95) * 1000:>9.1f}{percentile(values, 99) * 1000:>9.1f}")
+    completed = len(stats.latencies['download'])
+    print(f"completed flows: {completed} ({completed / elapsed:.2f}/s)")
+
+
+def wait_for_server(base_url, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.post(f"{base_url}/api/get_details", json={'foods': []}, timeout=1)
+            return True
+        except requests.RequestException:
+            time.sleep(0.2)
+    return False
+
+
+def spawn_env(work_dir, db_path):
+    """
+    Returns: environment for an app spawned on db_path, with every file it writes
+    (output, property shards, admission slots, uploads, memory stats, trace log) under work_dir.
+    """
+    env = dict(os.environ,
+               FOOD_DB_PATH=db_path,
+               OUTPUT_DIR=os.path.join(work_dir, 'output'),
+               PROPERTY_DB_DIR=os.path.join(work_dir, 'properties'),
+               ADMISSION_LOCK_DIR=os.path.join(work_dir, 'locks'),
+               UPLOAD_DIR=os.path.join(work_dir, 'uploads'),
+               MEMORY_STATS_DIR=os.path.join(work_dir, 'memstats'),
+               TRACE_LOG=os.path.join(work_dir, 'trace.log'))
+    os.makedirs(env['OUTPUT_DIR'], exist_ok=True)
+    return env
+
+
+def spawn_and_drive(config, port, work_dir, db_path, names, args):
+    workers, threads = (int(x) for x in config.split('x'))
+    env = spawn_env(work_dir, db_path)
+    cmd = [sys.executable, '-m', 'gunicorn', '-w', str(workers), '--threads', str(threads),
+           '-b', f"127.0.0.1:{port}", 'app:app']
+    proc = subprocess.Popen(cmd, cwd=ROOT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        if not wait_for_server(base_url):
+            print(f"Server for {config} did not start.")
+            return None
+        return drive(base_url, names, args)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the Buffet Tag HTTP API.")
+    parser.add_argument('--url', default='http://localhost:5050', help="Base url of a running app (ignored with --spawn)")
+    parser.add_argument('--spawn', action='store_true', help="Start gunicorn locally for each --configs entry")
+    parser.add_argument('--configs', default='4x1', help="Comma separated <workers>x<threads> layouts for --spawn")
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--dishes', type=int, default=0, help="Use a synthetic database with this many dishes")
+    parser.add_argument('--concurrency', type=int, default=4, help="Concurrent simulated users")
+    parser.add_argument('--rate', type=float, default=0, help="Target flows per second across all users (0 = as fast as possible)")
+    parser.add_argument('--duration', type=float, default=20, help="Seconds to run each configuration")
+    parser.add_argument('--min-items', type=int, default=15)
+    parser.add_argument('--max-items', type=int, default=50)
+    parser.add_argument('--missing-ratio', type=float, default=0.1, help="Share of menus containing an unknown dish")
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if not args.spawn:
+        if args.dishes:
+            print("Note: --dishes only applies to --spawn runs; using the running app's catalogue.")
+        # Read-only: sample names from the same database the running app serves
+        names = load_names(DB_PATH)
+        if not names:
+            print("Catalogue is empty, nothing to request.")
+            return
+        stats, elapsed = drive(args.url.rstrip('/'), names, args)
+        report(args.url, stats, elapsed)
+        return
+
+    work_dir = tempfile.mkdtemp(prefix='buffet_loadtest_')
+    try:
+        # Spawned servers never touch the live database, output folder, generation slots or logs
+        db_path = os.path.join(work_dir, 'food_database.db')
+        if args.dishes:
+            names = build_synthetic_db(db_path, args.dishes)
+        else:
+            shutil.copy(DB_PATH, db_path)
+            names = load_names(db_path)
+
+        for i, config in enumerate(args.configs.split(',')):
+            result = spawn_and_drive(config.strip(), args.port + i, work_dir, db_path, names, args)
+            if result:
+                report(f"gunicorn {config.strip()} (workers x threads)", *result)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
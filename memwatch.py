@@ -0,0 +1,228 @@
+"""
+Per-worker memory instrumentation for the Flask app, and the limit at which
+gunicorn.conf.py recycles a worker.
+
+After each request a worker records its RSS and how much each route grew it, in a
+small JSON file per process under MEMORY_STATS_DIR, so /api/admin/memory shows every
+gunicorn worker and not only the one that answers. With MEMORY_PROFILE=1 tracemalloc
+runs as well, and each route keeps the peak traced memory and the top allocation
+sites of its heaviest request (slower; meant for diagnosis).
+
+The peak memory check runs each scenario in a fresh process and fails when it
+grows RSS past its budget:
+
+    python3 memwatch.py --check
+    python3 memwatch.py --check --upload-rows 50000 --upload-budget 200
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+MEMORY_STATS_DIR = os.getenv('MEMORY_STATS_DIR', os.path.join(os.path.dirname(__file__), 'data', 'memstats'))
+MEMORY_PROFILE = os.getenv('MEMORY_PROFILE', '0') == '1'
+MEMORY_LIMIT_MB = int(os.getenv('MEMORY_LIMIT_MB', '512')) # 0 disables memory-based recycling
+TRACEMALLOC_FRAMES = int(os.getenv('TRACEMALLOC_FRAMES', '5'))
+TRACEMALLOC_TOP = int(os.getenv('TRACEMALLOC_TOP', '10'))
+STATS_INTERVAL = 1.0 # seconds between stats file writes
+
+MB = 1024 * 1024
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+_started = time.time()
+_routes = {}
+_last_write = 0.0
+
+def rss_bytes():
+    """Returns: this process's current resident set size (peak RSS where /proc is unavailable)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return peak_rss_bytes()
+
+def peak_rss_bytes():
+    """Returns: the highest RSS this process has reached."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 # bytes on macOS, KiB on Linux
+
+def begin():
+    """Call when a request starts. Returns: state for end()."""
+    if MEMORY_PROFILE:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        tracemalloc.reset_peak()
+    return rss_bytes()
+
+def _top_allocators(snapshot):
+    stats = snapshot.statistics('traceback')[:TRACEMALLOC_TOP]
+    return [{
+        'where': " <- ".join(f"{os.path.basename(f.filename)}:{f.lineno}" for f in reversed(s.traceback)),
+        'size_kb': round(s.size / 1024, 1),
+        'count': s.count
+    } for s in stats]
+
+def end(route, rss_before):
+    """Call when a request ends: records route's RSS growth (and traced peak when profiling)."""
+    rss = rss_bytes()
+    growth = rss - rss_before
+    stats = _routes.setdefault(route, {
+        'requests': 0, 'rss_growth_mb_total': 0.0, 'rss_growth_mb_max': 0.0, 'rss_after_mb_max': 0.0
+    })
+    stats['requests'] += 1
+    stats['rss_growth_mb_total'] = round(stats['rss_growth_mb_total'] + growth / MB, 2)
+    stats['rss_growth_mb_max'] = round(max(stats['rss_growth_mb_max'], growth / MB), 2)
+    stats['rss_after_mb_max'] = round(max(stats['rss_after_mb_max'], rss / MB), 2)
+
+    if MEMORY_PROFILE and tracemalloc.is_tracing():
+        peak = tracemalloc.get_traced_memory()[1]
+        if peak / MB > stats.get('traced_peak_mb', 0.0):
+            # Only the heaviest request per route pays for a snapshot
+            stats['traced_peak_mb'] = round(peak / MB, 2)
+            stats['top_allocators'] = _top_allocators(tracemalloc.take_snapshot())
+
+    global _last_write
+    if time.time() - _last_write >= STATS_INTERVAL:
+        _last_write = time.time()
+        _write_stats()
+
+def worker_stats():
+    """Returns: this process's memory stats."""
+    return {
+        'pid': os.getpid(),
+        'rss_mb': round(rss_bytes() / MB, 2),
+        'peak_rss_mb': round(peak_rss_bytes() / MB, 2),
+        'uptime_s': round(time.time() - _started),
+        'requests': sum(r['requests'] for r in _routes.values()),
+        'routes': _routes,
+        'updated': time.time()
+    }
+
+def _write_stats():
+    try:
+        os.makedirs(MEMORY_STATS_DIR, exist_ok=True)
+        path = os.path.join(MEMORY_STATS_DIR, f"{os.getpid()}.json")
+        with open(path + '.tmp', 'w') as f:
+            json.dump(worker_stats(), f)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        print(f"Memory stats write error: {e}")
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+def all_worker_stats():
+    """Returns: stats of every live worker (this one fresh, others as last written), by pid."""
+    _write_stats()
+    workers = []
+    for filename in sorted(os.listdir(MEMORY_STATS_DIR)):
+        if not filename.endswith('.json'):
+            continue
+        path = os.path.join(MEMORY_STATS_DIR, filename)
+        pid = int(filename[:-5]) if filename[:-5].isdigit() else None
+        if pid is None or not _alive(pid):
+            # Recycled or crashed worker
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path) as f:
+                workers.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return workers
+
+# Peak memory check
+
+def _scenario_generate(work_dir):
+    import excel_utils
+    excel_utils.OUTPUT_DIR = work_dir
+    names = [f"DISH {i:02d}" for i in range(excel_utils.MAX_ITEMS)]
+    custom_data = {name: {'calories': 100 + i, 'allergens': ['Milk', 'Gluten'] if i % 2 else []}
+                   for i, name in enumerate(names)}
+    return lambda: excel_utils.generate_excel(names, custom_data=custom_data)
+
+def _scenario_upload(work_dir):
+    import excel_utils
+    path = os.path.join(work_dir, 'upload.xlsx')
+    return lambda: excel_utils.process_bulk_upload_excel(path, rejected=[])
+
+def _write_upload_file(path, rows):
+    import openpyxl
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet('Upload')
+    ws.append(['Food Name', 'Calories', 'Allergens'])
+    for i in range(rows):
+        ws.append([f"UPLOAD DISH {i:05d}", i % 900, "Milk, Soy" if i % 3 else ""])
+    wb.save(path)
+
+SCENARIOS = {'generate': _scenario_generate, 'upload': _scenario_upload}
+
+def run_scenario(name, work_dir):
+    """Child process: runs one scenario after the imports it needs. Prints its memory as JSON."""
+    run = SCENARIOS[name](work_dir)
+    baseline = rss_bytes()
+    start = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - start
+    growth = peak_rss_bytes() - baseline
+
+    # Second, traced run: tracemalloc's own overhead would inflate the RSS figure above
+    tracemalloc.start()
+    run()
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    print(json.dumps({
+        'growth_mb': round(growth / MB, 1),
+        'traced_peak_mb': round(traced_peak / MB, 1),
+        'seconds': round(elapsed, 2)
+    }))
+
+def check(budgets, upload_rows):
+    """Runs each scenario in a fresh process. Returns: 0 if all stay within budget, else 1."""
+    failed = False
+    with tempfile.TemporaryDirectory(prefix='buffet_memcheck_') as work_dir:
+        _write_upload_file(os.path.join(work_dir, 'upload.xlsx'), upload_rows)
+        for name, budget in budgets.items():
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), '--scenario', name, work_dir],
+                                 capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            if out.returncode != 0:
+                print(f"{name}: failed\n{out.stderr}")
+                failed = True
+                continue
+            result = json.loads(out.stdout.strip().splitlines()[-1])
+            ok = result['growth_mb'] <= budget
+            failed = failed or not ok
+            print(f"{name:<9} RSS growth {result['growth_mb']:>7.1f} MB (budget {budget} MB), "
+                  f"traced peak {result['traced_peak_mb']:.1f} MB, {result['seconds']:.2f}s  {'OK' if ok else 'OVER BUDGET'}")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Peak memory check for tag generation and bulk upload.")
+    parser.add_argument('--check', action='store_true', help="Run every scenario and compare with its budget")
+    parser.add_argument('--scenario', nargs=2, metavar=('NAME', 'WORK_DIR'), help=argparse.SUPPRESS)
+    parser.add_argument('--generate-budget', type=float, default=float(os.getenv('GENERATE_BUDGET_MB', '30')),
+                        help="MB of RSS growth allowed for a 50-row generation")
+    parser.add_argument('--upload-budget', type=float, default=float(os.getenv('UPLOAD_BUDGET_MB', '80')),
+                        help="MB of RSS growth allowed for a bulk upload of --upload-rows rows")
+    parser.add_argument('--upload-rows', type=int, default=10000)
+    args = parser.parse_args()
+
+    if args.scenario:
+        run_scenario(*args.scenario)
+    elif args.check:
+        sys.exit(check({'generate': args.generate_budget, 'upload': args.upload_budget}, args.upload_rows))
+    else:
+        parser.print_help()
@@ -19,6 +19,6 @@ fi
 
 # Run the Flask app with Gunicorn (Production)
 echo "Starting Web Server (Gunicorn)..."
-# -w 4: 4 worker processes
-# -b 0.0.0.0:5050: Bind to all interfaces on port 5050
-exec gunicorn -w 4 -b 0.0.0.0:5050 app:app
+# gunicorn.conf.py: 4 worker processes (WEB_CONCURRENCY), bound to 0.0.0.0:5050 (BIND),
+# recycled when over MEMORY_LIMIT_MB or after MAX_REQUESTS requests
+exec gunicorn -c gunicorn.conf.py app:app
@@ -0,0 +1,15 @@
+#!/bin/bash
+cd "$(dirname "$0")"
+
+if [ ! -d "venv" ]; then
+    echo "Creating virtual environment..."
+    python3 -m venv venv
+    source venv/bin/activate
+    echo "Installing dependencies..."
+    pip install -r requirements.txt
+else
+    source venv/bin/activate
+fi
+
+echo "Starting Menu Scheduler..."
+python3 scheduler.py
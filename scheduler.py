@@ -0,0 +1,126 @@
+"""
+Background scheduler for saved menus.
+
+Renders a saved menu ahead of each service time (PREGENERATE_LEAD_MINUTES) and
+whenever one of its dishes changed in the catalogue, so fetching it is instant.
+Run alongside the web app: python3 scheduler.py
+"""
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+
+from database import init_db, list_menus, list_properties, use_property
+from excel_utils import render_saved_menu
+
+load_dotenv()
+
+PREGENERATE_LEAD_MINUTES = int(os.getenv("PREGENERATE_LEAD_MINUTES", "120"))
+SCHEDULER_INTERVAL = int(os.getenv("SCHEDULER_INTERVAL", "60"))
+
+DAY_NAMES = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+FULL_DAY_NAMES = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+def parse_schedule(text):
+    """
+    Parses a menu schedule such as "daily 07:00" or "mon,wed,fri 06:30,19:00".
+    Returns: (set of weekday numbers, list of (hour, minute)).
+    Raises ValueError on malformed input.
+    """
+    parts = text.strip().lower().split()
+    if len(parts) != 2:
+        raise ValueError('Schedule must look like "daily 07:00" or "mon,wed 06:30,19:00".')
+
+    days_text, times_text = parts
+    if days_text == 'daily':
+        days = set(range(7))
+    else:
+        days = set()
+        for day in days_text.split(','):
+            if day in DAY_NAMES:
+                days.add(DAY_NAMES.index(day))
+            elif day in FULL_DAY_NAMES:
+                days.add(FULL_DAY_NAMES.index(day))
+            else:
+                raise ValueError(f'Unknown day "{day}". Use {", ".join(DAY_NAMES)} (or full names) or daily.')
+
+    times = []
+    for t in times_text.split(','):
+        try:
+            parsed = datetime.strptime(t, '%H:%M')
+        except ValueError:
+            raise ValueError(f'Invalid time "{t}". Use HH:MM.')
+        times.append((parsed.hour, parsed.minute))
+
+    return days, times
+
+def next_service_time(schedule, now):
+    """Returns the first service datetime at or after now, or None if the schedule is empty."""
+    days, times = parse_schedule(schedule)
+    for offset in range(8):
+        day = (now + timedelta(days=offset)).date()
+        if day.weekday() not in days:
+            continue
+        for hour, minute in sorted(times):
+            service = datetime(day.year, day.month, day.day, hour, minute)
+            if service >= now:
+                return service
+    return None
+
+def is_due(menu, now):
+    """A menu is due if its dishes changed, or a service is coming up and it was not prepared for it yet."""
+    if menu['stale'] or not menu['rendered_at']:
+        return True
+    if not menu['schedule']:
+        return False
+
+    try:
+        service = next_service_time(menu['schedule'], now)
+    except ValueError as e:
+        logging.warning(f"Menu {menu['name']}: {e}")
+        return False
+    if service is None:
+        return False
+
+    window_open = service - timedelta(minutes=PREGENERATE_LEAD_MINUTES)
+    return now >= window_open and datetime.fromisoformat(menu['rendered_at']) < window_open
+
+def run_once(now=None):
+    """
+    Renders every due menu of the global tier and of each property.
+    Returns: list of rendered menus ("<property>/<name>" for property menus).
+    """
+    now = now or datetime.now()
+    rendered = []
+    for key in [None] + list_properties():
+        with use_property(key):
+            rendered += [f"{key}/{name}" if key else name for name in _run_tier(now)]
+    return rendered
+
+def _run_tier(now):
+    rendered = []
+    for menu in list_menus():
+        if not is_due(menu, now):
+            continue
+        try:
+            _, missing = render_saved_menu(menu)
+            rendered.append(menu['name'])
+            if missing:
+                logging.warning(f"Menu {menu['name']} rendered with missing dishes: {', '.join(missing)}")
+            else:
+                logging.info(f"Menu {menu['name']} rendered.")
+        except Exception as e:
+            logging.error(f"Menu {menu['name']} failed to render: {e}")
+    return rendered
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    init_db()
+    print("Scheduler is running...")
+    while True:
+        run_once()
+        time.sleep(SCHEDULER_INTERVAL)
@@ -4,6 +4,7 @@ cd "$(dirname "$0")"
 # Make sure the base runner scripts are executable
 chmod +x run_app.sh
 chmod +x run_bot.sh
+chmod +x run_scheduler.sh
 
 echo "Starting Web App in background..."
 nohup ./run_app.sh > app.log 2>&1 &
@@ -15,6 +16,11 @@ nohup ./run_bot.sh > bot.log 2>&1 &
 echo $! > bot.pid
 echo "Telegram Bot running. PID: $(cat bot.pid)"
 
+echo "Starting Menu Scheduler in background..."
+nohup ./run_scheduler.sh > scheduler.log 2>&1 &
+echo $! > scheduler.pid
+echo "Menu Scheduler running. PID: $(cat scheduler.pid)"
+
 echo "-----------------------------------"
 echo "Processes are running in the background."
 echo "You can close this terminal now."
@@ -26,3 +26,16 @@ if [ -f bot.pid ]; then
 else
     echo "No bot.pid file found."
 fi
+
+if [ -f scheduler.pid ]; then
+    PID=$(cat scheduler.pid)
+    if ps -p $PID > /dev/null; then
+        kill $PID
+        echo "Menu Scheduler (PID $PID) stopped."
+    else
+        echo "Menu Scheduler (PID $PID) was not running."
+    fi
+    rm scheduler.pid
+else
+    echo "No scheduler.pid file found."
+fi
@@ -1,21 +1,33 @@
+import asyncio
+import hashlib
+import io
 import logging
 import requests
 import os
 import json
+import random
+import re
+import tempfile
+import threading
+import time
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, constants
-from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters, ConversationHandler
+from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters, ConversationHandler, BaseUpdateProcessor
 from dotenv import load_dotenv
 
 load_dotenv()
 
 import sys
 
-# Add parent directory to sys.path to import excel_utils
+# Add parent directory to sys.path to import excel_utils and database
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 sys.path.append(parent_dir)
 
-from excel_utils import extract_names_from_excel
+from database import normalize_property
+from excel_utils import extract_names_batch, preview_rows, ArchiveTooLarge, EXTRACT_RANGE
+from tracing import TRACE_HEADER, new_trace_id, span, set_service, list_traces, waterfall
+
+set_service('bot')
 
 # Configure logging
 logging.basicConfig(
@@ -25,9 +37,29 @@ logging.basicConfig(
 
 # Constants
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-API_BASE_URL = "http://localhost:5000/api"
+API_BASE_URL = os.getenv("API_BASE_URL", "http://localhost:5000/api")
 ADMIN_USER_ID = int(os.getenv("ADMIN_USER_ID", "0"))
-ALLOWED_USERS_FILE = os.path.join(os.path.dirname(__file__), 'allowed_users.json')
+ALLOWED_USERS_FILE = os.getenv("ALLOWED_USERS_FILE", os.path.join(os.path.dirname(__file__), 'allowed_users.json'))
+# Property (hotel) whose catalogue a user works on; empty means the shared global catalogue
+DEFAULT_PROPERTY = os.getenv("DEFAULT_PROPERTY", "")
+# Uploaded documents up to this size are kept in memory; larger ones spill to a unique temp file
+MAX_IN_MEMORY_UPLOAD = int(os.getenv("MAX_IN_MEMORY_UPLOAD", str(10 * 1024 * 1024)))
+# Retries when the API answers 429/503 (generation at capacity)
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "4"))
+API_MAX_BACKOFF = 30
+# Bulk uploads are sent in chunks of this size and resume after a dropped connection
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+# Webhook mode: set WEBHOOK_URL (public https base url) to receive updates instead of long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+# Required with WEBHOOK_URL: Telegram sends it with every push and the listener rejects pushes without it
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+# Bot API server; point at telegram_bot/fake_telegram.py to run the flows offline
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+# Updates handled at once, so one chat's generation does not hold up the others
+CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "32"))
 
 
 VALID_ALLERGENS = [
@@ -51,6 +83,12 @@ ADD_MULTIPLE_FILE = 6
 # Global dictionary to store temporary user data
 user_data_store = {}
 
+# Selected property per user (outlives conversations, reset on restart)
+user_properties = {}
+
+# Trace id of each user's latest conversation, sent to the API as X-Trace-Id
+user_traces = {}
+
 # --- Helper Functions ---
 
 def validate_allergens(text):
@@ -82,6 +120,197 @@ def validate_allergens(text):
     
     return valid_list, None
 
+async def download_document(document, trace_id=None):
+    """
+    Downloads a Telegram document without touching the working directory.
+    Returns: (source, temp_path) where source is a BytesIO (or an open file for large
+             documents) and temp_path is the spill file to remove afterwards, or None.
+    """
+    with span('telegram.download', trace_id=trace_id, size=document.file_size):
+        file = await document.get_file()
+        if document.file_size and document.file_size > MAX_IN_MEMORY_UPLOAD:
+            fd, temp_path = tempfile.mkstemp(suffix='.xlsx', prefix='buffet_upload_')
+            os.close(fd)
+            await file.download_to_drive(temp_path)
+            return open(temp_path, 'rb'), temp_path
+
+        buffer = io.BytesIO()
+        await file.download_to_memory(buffer)
+        buffer.seek(0)
+        return buffer, None
+
+def close_document(source, temp_path):
+    source.close()
+    if temp_path and os.path.exists(temp_path):
+        os.remove(temp_path)
+
+def upload_in_chunks(source, filename, mode, headers):
+    """
+    Sends a workbook through the chunked upload API (/api/uploads) and finalizes it.
+    A failed or rejected (400) chunk is retried from the offset the server acknowledged,
+    up to API_MAX_RETRIES times in a row.
+    source: Binary file-like object, read from the start.
+    Returns: the finalize response (same body as /api/bulk_upload).
+    """
+    source.seek(0)
+    digest = hashlib.sha256()
+    for block in iter(lambda: source.read(UPLOAD_CHUNK_SIZE), b''):
+        digest.update(block)
+    size = source.tell()
+
+    res = requests.post(f"{API_BASE_URL}/uploads", headers=headers,
+                        json={'filename': filename, 'size': size, 'sha256': digest.hexdigest(), 'mode': mode})
+    if res.status_code != 201:
+        return res
+    upload_url = f"{API_BASE_URL}/uploads/{res.json()['upload_id']}"
+    chunk_size = res.json().get('chunk_size', UPLOAD_CHUNK_SIZE)
+
+    offset = 0
+    failures = 0
+    while offset < size:
+        source.seek(offset)
+        chunk = source.read(chunk_size)
+        try:
+            res = requests.put(upload_url, params={'offset': offset}, data=chunk, timeout=60,
+                               headers=dict(headers, **{'X-Chunk-Sha256': hashlib.sha256(chunk).hexdigest()}))
+            if res.status_code in (200, 409):
+                # 409: the server already has more (or less) than we thought; continue from its offset
+                offset = res.json()['offset']
+                failures = 0
+                continue
+            if res.status_code == 400:
+                # Checksum mismatch: the chunk was damaged on the way, send it again
+                logging.warning(f"Upload chunk at {offset} rejected: {res.text}")
+            elif res.status_code < 500:
+                return res
+        except requests.RequestException as e:
+            logging.warning(f"Upload chunk at {offset} failed: {e}")
+        failures += 1
+        if failures > API_MAX_RETRIES:
+            raise RuntimeError(f"Upload stopped at {offset} of {size} bytes.")
+        time.sleep(min(API_MAX_BACKOFF, 2 ** failures))
+        try:
+            status = requests.get(upload_url, headers=headers, timeout=30)
+            if status.status_code == 200:
+                offset = status.json()['offset']
+        except requests.RequestException:
+            pass
+
+    return requests.post(f"{upload_url}/finalize", headers=headers)
+
+async def call_api(method, url, update=None, **kwargs):
+    """
+    Calls the API off the event loop. While it answers 429/503 (busy), waits for its
+    Retry-After (doubling at least every attempt, with jitter) and retries.
+    update: Tells this chat once that the request is waiting.
+    Returns: the last response.
+    """
+    delay = 1
+    for attempt in range(API_MAX_RETRIES + 1):
+        response = await asyncio.to_thread(requests.request, method, url, **kwargs)
+        if response.status_code not in (429, 503) or attempt == API_MAX_RETRIES:
+            return response
+        try:
+            wait = float(response.headers.get('Retry-After', delay))
+        except ValueError:
+            wait = delay
+        wait = min(API_MAX_BACKOFF, max(wait, delay)) + random.uniform(0, 1)
+        if update and attempt == 0:
+            await update.message.reply_text(f"Server is busy, retrying in {wait:.0f}s...")
+        await asyncio.sleep(wait)
+        delay *= 2
+
+def api_headers(user_id):
+    """Headers that route an API call to the user's property and tie it to the user's trace."""
+    headers = {}
+    key = user_properties.get(user_id, DEFAULT_PROPERTY)
+    if key:
+        headers['X-Property'] = key
+    if user_id in user_traces:
+        headers[TRACE_HEADER] = user_traces[user_id]
+    return headers
+
+def begin_trace(user_id):
+    """Mints the correlation id for a new conversation/command of user_id."""
+    user_traces[user_id] = new_trace_id()
+    return user_traces[user_id]
+
+def trace_of(user_id):
+    return user_traces.get(user_id)
+
+class CatalogueMirror:
+    """
+    In-memory copy of one property's catalogue, kept current by applying the
+    /api/changes delta feed, so lookups need no API round trip per message.
+    """
+    def __init__(self, property_key):
+        self.property_key = property_key
+        self.global_items = {}
+        self.property_items = {}
+        self.cursor = '0'
+        self.lock = threading.Lock()
+
+    def refresh(self, trace_id=None):
+        """Pulls changes since the last refresh (blocking; run off the event loop)."""
+        headers = {'X-Property': self.property_key} if self.property_key else {}
+        if trace_id:
+            headers[TRACE_HEADER] = trace_id
+        with self.lock:
+            while True:
+                res = requests.get(f"{API_BASE_URL}/changes", params={'since': self.cursor}, headers=headers, timeout=10)
+                res.raise_for_status()
+                data = res.json()
+                for change in data['changes']:
+                    target = self.property_items if change['tier'] == 'property' else self.global_items
+                    target[change['name']] = change
+                self.cursor = data['cursor']
+                if not data['has_more']:
+                    break
+
+    def get(self, name):
+        return self.property_items.get(name) or self.global_items.get(name)
+
+    def missing(self, food_list):
+        """Same normalisation as /api/process: stripped, upper case, first occurrence order."""
+        missing = []
+        for name in food_list:
+            clean_name = name.strip().upper()
+            if clean_name and not self.get(clean_name) and clean_name not in missing:
+                missing.append(clean_name)
+        return missing
+
+    def details(self, food_list):
+        """Same shape as /api/get_details data; copies, since the verify loop edits them."""
+        results = []
+        for name in food_list:
+            clean_name = name.strip().upper()
+            if not clean_name:
+                continue
+            item = self.get(clean_name)
+            if item:
+                results.append({'name': item['name'], 'calories': item['calories'], 'allergens': item['allergens']})
+            else:
+                results.append({'name': clean_name, 'calories': 0, 'allergens': ''})
+        return results
+
+# One mirror per property key
+catalogue_mirrors = {}
+
+async def get_mirror(user_id):
+    """
+    Returns: the user's property mirror refreshed with one delta request,
+             or None if the change feed is unavailable (callers fall back to the API).
+    """
+    key = user_properties.get(user_id, DEFAULT_PROPERTY)
+    mirror = catalogue_mirrors.setdefault(key, CatalogueMirror(key))
+    try:
+        with span('mirror.refresh', trace_id=trace_of(user_id)):
+            await asyncio.to_thread(mirror.refresh, trace_of(user_id))
+        return mirror
+    except Exception as e:
+        logging.warning(f"Catalogue mirror refresh failed, using API: {e}")
+        return None
+
 # --- User Management ---
 
 def load_allowed_users():
@@ -133,10 +362,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = (
         "Welcome to the Buffet Tag Bot!\n\n"
         "Send me a list of food items (one per line) to generate tags.\n"
-        "If an item is missing, I'll ask you for details."
+        "If an item is missing, I'll ask you for details.\n"
+        "/menus - List saved menus\n/menu <name> - Get a saved menu's file\n/allergens <menu> - Allergen overview\n"
+        "/property <key> - Switch hotel catalogue"
     )
     if user_id == ADMIN_USER_ID:
-        msg += "\n\nAdmin Commands:\n/add_single - Add new item\n/add_multiple - Bulk upload\n/add_user <id> - Allow user"
+        msg += "\n\nAdmin Commands:\n/add_single - Add new item\n/add_multiple [upsert] - Bulk upload\n/add_user <id> - Allow user\n/export [csv] - Download the catalogue"
     
     await update.message.reply_text(msg)
 
@@ -153,28 +384,208 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Valid Allergens:\n" + ", ".join(VALID_ALLERGENS)
     )
 
-async def show_verification_list(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id, food_list):
+async def property_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows or selects the property (hotel) catalogue: /property [key|global]"""
+    user_id = update.effective_user.id
+    if not is_allowed(user_id):
+        await update.message.reply_text("Unauthorized access.")
+        return
+
+    if context.args:
+        if context.args[0].strip().lower() == 'global':
+            key = ''
+        else:
+            try:
+                key = normalize_property(context.args[0]) or ''
+            except ValueError as e:
+                await update.message.reply_text(str(e))
+                return
+        if key:
+            try:
+                res = await asyncio.to_thread(requests.get, f"{API_BASE_URL}/properties", timeout=10)
+                known = res.json().get('properties', []) if res.status_code == 200 else None
+            except (requests.RequestException, ValueError):
+                known = None
+            if known is None:
+                await update.message.reply_text("Could not check the property, please try again.")
+                return
+            if key not in known:
+                await update.message.reply_text(f"Unknown property: {key}. Ask the admin to create it.")
+                return
+        user_properties[user_id] = key
+
+    current = user_properties.get(user_id, DEFAULT_PROPERTY) or 'global'
+    await update.message.reply_text(f"Current property: {current}\nChange with /property <key> (or /property global).")
+
+async def trace_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows the timing waterfall of your last conversation: /trace [trace_id] (ids: admin only)"""
+    user_id = update.effective_user.id
+    if not is_allowed(user_id):
+        await update.message.reply_text("Unauthorized access.")
+        return
+
+    if context.args and context.args[0] == 'list' and user_id == ADMIN_USER_ID:
+        lines = [f"{tid}  {total_ms:.0f} ms  {count} spans" for tid, _, total_ms, count in list_traces(10)]
+        text = "\n".join(lines) or "No traces recorded."
+    else:
+        trace_id = context.args[0] if context.args and user_id == ADMIN_USER_ID else trace_of(user_id)
+        if not trace_id:
+            await update.message.reply_text("No conversation traced yet.")
+            return
+        text = waterfall(trace_id, width=20)
+    await update.message.reply_text(f"```\n{text[:3900]}\n```", parse_mode=constants.ParseMode.MARKDOWN)
+
+async def menus_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lists saved menus."""
+    if not is_allowed(update.effective_user.id):
+        await update.message.reply_text("Unauthorized access.")
+        return
+
+    try:
+        response = await asyncio.to_thread(requests.get, f"{API_BASE_URL}/menus", headers=api_headers(update.effective_user.id))
+        menus = response.json().get('menus', [])
+        if not menus:
+            await update.message.reply_text("No saved menus yet.")
+            return
+        lines = ["Saved menus:"]
+        for m in menus:
+            state = "ready" if m['ready'] else "pending"
+            lines.append(f"• {m['name']} ({len(m['dishes'])} dishes, {m['schedule'] or 'no schedule'}, {state})")
+        lines.append("\nSend /menu <name> to get the file.")
+        await update.message.reply_text("\n".join(lines))
+    except Exception as e:
+        await update.message.reply_text(f"Error: {e}")
+
+async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Sends the pre-rendered file of a saved menu: /menu <name>"""
+    if not is_allowed(update.effective_user.id):
+        await update.message.reply_text("Unauthorized access.")
+        return
+
+    if not context.args:
+        await update.message.reply_text("Usage: /menu <name>")
+        return
+
+    name = " ".join(context.args)
+    trace_id = begin_trace(update.effective_user.id)
+    try:
+        with span('api.menu', trace_id=trace_id):
+            response = await call_api('GET', f"{API_BASE_URL}/menus/{requests.utils.quote(name, safe='')}", update,
+                                      headers=api_headers(update.effective_user.id))
+        data = response.json()
+        if response.status_code != 200:
+            await update.message.reply_text(data.get('error', 'Error fetching menu.'))
+            return
+
+        download_url = data['download_url'].replace('0.0.0.0', 'localhost')
+        with span('download', trace_id=trace_id):
+            file_res = await asyncio.to_thread(requests.get, download_url, headers={TRACE_HEADER: trace_id})
+        if file_res.status_code == 200:
+            with span('telegram.send_document', trace_id=trace_id):
+                await update.message.reply_document(document=file_res.content, filename=os.path.basename(download_url))
+            if data['missing_items']:
+                await update.message.reply_text(f"Missing from database: {', '.join(data['missing_items'])}")
+        else:
+            await update.message.reply_text("Error downloading file.")
+    except Exception as e:
+        await update.message.reply_text(f"Error: {e}")
+
+async def allergens_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Fetches details from API and shows verification message.
+    Allergen overview of a saved menu (/allergens <menu name>) or of dishes listed one
+    per line below the command. Replies with the counts and sends the summary sheet.
     """
+    user_id = update.effective_user.id
+    if not is_allowed(user_id):
+        await update.message.reply_text("Unauthorized access.")
+        return
+
+    lines = [line.strip() for line in update.message.text.split('\n')[1:] if line.strip()]
+    if lines:
+        payload = {'foods': lines, 'sheet': True}
+    elif context.args:
+        payload = {'menu': " ".join(context.args), 'sheet': True}
+    else:
+        await update.message.reply_text("Usage: /allergens <menu name>, or the dishes one per line below /allergens")
+        return
+
+    trace_id = begin_trace(user_id)
     try:
-        response = requests.post(f"{API_BASE_URL}/get_details", json={'foods': food_list})
+        with span('api.allergen_summary', trace_id=trace_id):
+            response = await asyncio.to_thread(requests.post, f"{API_BASE_URL}/allergen_summary", json=payload,
+                                               headers=api_headers(user_id))
         data = response.json()
+        if response.status_code != 200:
+            await update.message.reply_text(data.get('error', 'Error building the allergen summary.'))
+            return
+
+        msg_lines = [f"Allergens in {len(data['dishes'])} dishes:"]
+        for allergen in data['allergens']:
+            if data['counts'][allergen]:
+                msg_lines.append(f"• {allergen}: {data['counts'][allergen]}")
+        msg_lines.append(f"Allergen-free: {len(data['allergen_free'])}")
+        if data['missing']:
+            msg_lines.append(f"Not in database: {', '.join(data['missing'])}")
+        await update.message.reply_text("\n".join(msg_lines))
+
+        download_url = data['download_url'].replace('0.0.0.0', 'localhost')
+        file_res = await asyncio.to_thread(requests.get, download_url, headers={TRACE_HEADER: trace_id})
+        if file_res.status_code == 200:
+            await update.message.reply_document(document=file_res.content, filename=os.path.basename(download_url))
+    except Exception as e:
+        await update.message.reply_text(f"Error: {e}")
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin: sends the full catalogue in the bulk upload format: /export [csv]"""
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("Unauthorized.")
+        return
+
+    export_format = 'csv' if context.args and context.args[0].lower() == 'csv' else 'xlsx'
+    try:
+        res = await asyncio.to_thread(requests.get, f"{API_BASE_URL}/export", params={'format': export_format},
+                                      headers=api_headers(update.effective_user.id))
+        if res.status_code == 200:
+            await update.message.reply_document(document=res.content, filename=f"catalogue.{export_format}")
+        else:
+            await update.message.reply_text(f"Export failed: {res.text}")
+    except Exception as e:
+        await update.message.reply_text(f"Error: {e}")
+
+async def show_verification_list(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id, food_list):
+    """
+    Fetches details (from the catalogue mirror, else the API) and shows verification message.
+    """
+    try:
+        mirror = await get_mirror(user_id)
+        if mirror:
+            data = {'status': 'success', 'data': mirror.details(food_list)}
+            status_code = 200
+        else:
+            with span('api.get_details', trace_id=trace_of(user_id)):
+                response = await asyncio.to_thread(requests.post, f"{API_BASE_URL}/get_details", json={'foods': food_list},
+                                                   headers=api_headers(user_id))
+            data = response.json()
+            status_code = response.status_code
         
-        if response.status_code == 200 and data.get('status') == 'success':
+        if status_code == 200 and data.get('status') == 'success':
             items = data['data']
             # Store full objects in user_data for editing
             # We use a dict for user session: {'verification_items': [obj1, obj2...]}
             user_data_store[user_id]['verification_items'] = items
             
-            # Format message
+            # Show what the sheet will actually print, computed in memory like /api/preview
+            preview = preview_rows([item['name'] for item in items],
+                                   custom_data={item['name']: item for item in items})
             msg_lines = ["**Review Allergens** (Session only):"]
-            for idx, item in enumerate(items):
-                # item['allergens'] is string from DB usually
-                algs = item['allergens']
-                if not algs:
-                    algs = "None"
-                msg_lines.append(f"{idx+1}. {item['name']} [{algs}]")
+            for idx, row in enumerate(preview['rows']):
+                algs = ", ".join(row['allergens']) or "None"
+                msg_lines.append(f"{idx+1}. {row['name']} [{algs}]")
+                if row['dropped']:
+                    msg_lines.append(f"   ⚠️ Not printed: {', '.join(row['dropped'])}")
+            if preview['truncated']:
+                msg_lines.append(f"\n⚠️ Only the first {len(preview['rows'])} items fit the sheet; "
+                                 f"{len(preview['truncated'])} more will be left out.")
                 
             msg_lines.append("\nCommands:")
             msg_lines.append("• `change <N> <New Allergens>` (e.g., `change 1 Soy, Gluten`)")
@@ -204,15 +615,18 @@ async def verify_loop(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Generating file...")
         try:
             # Send custom data to generate API
-            payload = {'foods': items}
-            response = requests.post(f"{API_BASE_URL}/generate_custom", json=payload)
+            payload = {'foods': items, 'session_id': f"telegram-{user_id}"}
+            with span('api.generate_custom', trace_id=trace_of(user_id)):
+                response = await call_api('POST', f"{API_BASE_URL}/generate_custom", update, json=payload, headers=api_headers(user_id))
             data = response.json()
             
             if response.status_code == 200 and data.get('status') == 'complete':
                 download_url = data['download_url'].replace('0.0.0.0', 'localhost')
-                file_res = requests.get(download_url)
+                with span('download', trace_id=trace_of(user_id)):
+                    file_res = await asyncio.to_thread(requests.get, download_url, headers=api_headers(user_id))
                 if file_res.status_code == 200:
-                    await update.message.reply_document(document=file_res.content, filename=os.path.basename(download_url))
+                    with span('telegram.send_document', trace_id=trace_of(user_id)):
+                        await update.message.reply_document(document=file_res.content, filename=os.path.basename(download_url))
                 else:
                     await update.message.reply_text("Error downloading file.")
             else:
@@ -258,37 +672,50 @@ async def verify_loop(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return VERIFY_ALLERGENS
 
 async def extract_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Starts the extraction process."""
+    """Starts the extraction process. Usage: /extract_names [range], e.g. /extract_names D2:D80"""
     user = update.effective_user
     # No admin check needed as requested
+    cell_range = context.args[0].upper() if context.args else EXTRACT_RANGE
+    # Only this flow's key: the user's other conversations keep their state
+    user_data_store.setdefault(user.id, {})['extract_range'] = cell_range
     
     await update.message.reply_text(
-        "Please upload the Excel file you want to extract food names from (Column D, Rows 2-60).\n"
+        f"Please upload the Excel file (or a .zip of several) you want to extract food names from ({cell_range}, every sheet).\n"
         "/cancel - Cancel the current operation\n"
-        "/extract_names - Extract food names from an Excel file (D2:D60)"
+        "/extract_names <range> - Extract from another range, e.g. /extract_names D2:D80"
     )
     return EXTRACT_UPLOAD
 
 async def handle_extract_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handles the Excel file upload for extraction."""
+    """Handles the Excel or zip upload for extraction."""
     user = update.effective_user
     document = update.message.document
     
-    if not document.file_name.endswith('.xlsx'):
-        await update.message.reply_text("Please upload a valid .xlsx file.")
+    if not document.file_name.lower().endswith(('.xlsx', '.zip')):
+        await update.message.reply_text("Please upload a valid .xlsx or .zip file.")
         return EXTRACT_UPLOAD
         
-    file = await document.get_file()
-    temp_path = f"temp_extract_{user.id}.xlsx"
-    await file.download_to_drive(temp_path)
+    cell_range = user_data_store.get(user.id, {}).get('extract_range', EXTRACT_RANGE)
+    trace_id = begin_trace(user.id)
+    source, temp_path = await download_document(document, trace_id)
     
     try:
-        names = extract_names_from_excel(temp_path)
+        # Parsing is CPU bound; keep the event loop free for other chats
+        with span('extract_names', trace_id=trace_id):
+            items, stats = await asyncio.to_thread(extract_names_batch, [(document.file_name, source)], cell_range)
         
-        if names:
+        if items:
             # Wrap whole list in triple backticks for one-click copy
-            names_text = "\n".join(names)
-            response_text = f"Extracted Names:\n\n```\n{names_text}\n```"
+            names_text = "\n".join(i['name'] for i in items)
+            response_text = f"Extracted Names ({len(items)}):\n\n```\n{names_text}\n```"
+            if stats['sheets'] > 1:
+                counts = {}
+                for item in items:
+                    for src in item['sources']:
+                        key = f"{src['file']} > {src['sheet']}"
+                        counts[key] = counts.get(key, 0) + 1
+                sources_text = "\n".join(f"{key}: {n}" for key, n in counts.items())
+                response_text += f"\nSources:\n```\n{sources_text}\n```"
             # Split if too long (Telegram limit 4096)
             if len(response_text) > 4000:
                  # Simple chunking
@@ -298,13 +725,17 @@ async def handle_extract_upload(update: Update, context: ContextTypes.DEFAULT_TY
             else:
                 await update.message.reply_text(response_text, parse_mode=constants.ParseMode.MARKDOWN)
         else:
-            await update.message.reply_text("No valid food names found in D2:D60.")
+            await update.message.reply_text(f"No valid food names found in {cell_range}.")
             
+    except ArchiveTooLarge as e:
+        await update.message.reply_text(f"Archive rejected: {e}")
+    except ValueError:
+        await update.message.reply_text(f"Invalid cell range: {cell_range}. Use e.g. /extract_names D2:D60")
     except Exception as e:
         await update.message.reply_text(f"Error processing file: {e}")
     finally:
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+        close_document(source, temp_path)
+        user_data_store.get(user.id, {}).pop('extract_range', None)
             
     return ConversationHandler.END
 
@@ -329,11 +760,23 @@ async def process_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Please send a valid list of food items.")
         return
 
+    # Every list starts a new conversation trace
+    begin_trace(update.effective_user.id)
     try:
-        response = requests.post(f"{API_BASE_URL}/process", json={'foods': food_list})
-        data = response.json()
+        mirror = await get_mirror(update.effective_user.id)
+        if mirror:
+            # Check the list locally against the mirrored catalogue
+            missing = mirror.missing(food_list)
+            data = {'status': 'missing_data', 'missing_items': missing} if missing else {'status': 'complete'}
+            status_code = 200
+        else:
+            with span('api.process', trace_id=trace_of(update.effective_user.id)):
+                response = await call_api('POST', f"{API_BASE_URL}/process", update, json={'foods': food_list},
+                                          headers=api_headers(update.effective_user.id))
+            data = response.json()
+            status_code = response.status_code
         
-        if response.status_code == 200:
+        if status_code == 200:
             if data.get('status') == 'complete':
                 # Instead of downloading immediately, go to Verification
                 if user_id := update.effective_user.id:
@@ -350,10 +793,13 @@ async def process_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 }
                 
                 first_missing = missing[0]
+                missing_lines = "\n".join(f"{i + 1}. **{name}**" for i, name in enumerate(missing))
                 await update.message.reply_text(
-                    f"I found some missing items.\n\n"
-                    f"1. **{first_missing}**\n"
-                    f"Please enter the **Calories** (number) for {first_missing}:",
+                    f"I found {len(missing)} missing items.\n\n"
+                    f"{missing_lines}\n\n"
+                    f"Reply with all of them in one message, one line per dish:\n"
+                    f"`NAME | calories | allergens` (e.g. `{first_missing} | 250 | Milk, Gluten`)\n\n"
+                    f"Or enter the **Calories** (number) for {first_missing} to add them one by one:",
                     parse_mode='Markdown'
                 )
                 return ASK_CALORIES
@@ -373,6 +819,8 @@ async def ask_calories(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
         
     calories_text = update.message.text
+    if '|' in calories_text:
+        return await add_missing_batch(update, context, user_id, calories_text)
     if not calories_text.isdigit():
         await update.message.reply_text("Please enter a valid number.")
         return ASK_CALORIES
@@ -401,7 +849,8 @@ async def ask_allergens(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Add to DB
     payload = {'name': current_food, 'calories': data_store['current_calories'], 'allergens': valid_allergens}
     try:
-        requests.post(f"{API_BASE_URL}/add_food", json=payload)
+        with span('api.add_food', trace_id=trace_of(user_id)):
+            await asyncio.to_thread(requests.post, f"{API_BASE_URL}/add_food", json=payload, headers=api_headers(user_id))
     except Exception as e:
         logging.error(f"Add Error: {e}")
 
@@ -418,6 +867,81 @@ async def ask_allergens(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # User store kept for verification items
         return await show_verification_list(update, context, user_id, original_list)
 
+def parse_missing_batch(text, pending):
+    """
+    Parses a batch reply of `NAME | calories | allergens` lines for the pending missing dishes.
+    Returns: (items for /api/add_foods, list of error lines)
+    """
+    pending_set = set(pending)
+    items = []
+    errors = []
+    seen = set()
+    for line_no, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        parts = [p.strip() for p in line.split('|')]
+        if len(parts) not in (2, 3):
+            errors.append(f"Line {line_no}: expected `NAME | calories | allergens`.")
+            continue
+        name, calories_text = parts[0].upper(), parts[1]
+        allergens_text = parts[2] if len(parts) == 3 else ''
+        if name not in pending_set:
+            errors.append(f"Line {line_no}: {name} is not one of the missing items.")
+            continue
+        if name in seen:
+            errors.append(f"Line {line_no}: {name} is listed twice.")
+            continue
+        if not calories_text.isdigit():
+            errors.append(f"Line {line_no} ({name}): calories must be a number.")
+            continue
+        valid_allergens, error_msg = validate_allergens(allergens_text)
+        if error_msg:
+            errors.append(f"Line {line_no} ({name}): invalid allergens `{allergens_text}`.")
+            continue
+        seen.add(name)
+        items.append({'name': name, 'calories': int(calories_text), 'allergens': valid_allergens})
+    return items, errors
+
+async def add_missing_batch(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id, text):
+    """Adds every valid line of a batch reply with one API call and reports all bad lines together."""
+    data_store = user_data_store[user_id]
+    pending = data_store['missing_items'][data_store['current_index']:]
+    items, errors = parse_missing_batch(text, pending)
+
+    added = set()
+    if items:
+        try:
+            with span('api.add_foods', trace_id=trace_of(user_id), count=len(items)):
+                res = await asyncio.to_thread(requests.post, f"{API_BASE_URL}/add_foods", json={'foods': items},
+                                              headers=api_headers(user_id))
+            if res.status_code == 200:
+                data = res.json()
+                # Dishes added meanwhile by someone else are in the catalogue too
+                added = set(data['added_items']) | set(data['skipped_duplicates'])
+            else:
+                errors.append(f"Could not add items: API returned {res.status_code}")
+        except Exception as e:
+            logging.error(f"Add Error: {e}")
+            errors.append(f"Could not add items: {e}")
+
+    remaining = [name for name in pending if name not in added]
+    data_store['missing_items'] = remaining
+    data_store['current_index'] = 0
+
+    if not remaining:
+        await update.message.reply_text(f"All {len(added)} items added! Proceeding to verification...")
+        return await show_verification_list(update, context, user_id, data_store['food_list'])
+
+    msg = [f"Added {len(added)} items." if added else "Nothing was added."]
+    if errors:
+        msg.append("Problems:\n" + "\n".join(errors))
+        if any('allergens' in e for e in errors):
+            msg.append(f"Valid allergens: `{', '.join(VALID_ALLERGENS)}`")
+    msg.append("Still missing: " + ", ".join(f"**{name}**" for name in remaining))
+    msg.append(f"Reply with the corrected lines, or enter the **Calories** for {remaining[0]}:")
+    await update.message.reply_text("\n\n".join(msg), parse_mode='Markdown')
+    return ASK_CALORIES
+
 # --- Admin Flow: Add Single Item ---
 
 async def add_single_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -463,7 +987,7 @@ async def add_single_allergens(update: Update, context: ContextTypes.DEFAULT_TYP
     }
     
     try:
-        res = requests.post(f"{API_BASE_URL}/add_food", json=payload)
+        res = await asyncio.to_thread(requests.post, f"{API_BASE_URL}/add_food", json=payload, headers=api_headers(user_id))
         if res.status_code == 200:
             await update.message.reply_text(f"Success! Added **{data['new_food_name']}**.", parse_mode='Markdown')
         elif res.status_code == 409:
@@ -483,7 +1007,10 @@ async def add_multiple_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if update.effective_user.id != ADMIN_USER_ID:
         await update.message.reply_text("Unauthorized.")
         return ConversationHandler.END
-    await update.message.reply_text("Please upload the **.xlsx file** for bulk upload:", parse_mode='Markdown')
+    # "/add_multiple upsert" also updates existing items whose values changed
+    mode = 'upsert' if context.args and context.args[0].lower() == 'upsert' else 'add'
+    user_data_store.setdefault(update.effective_user.id, {})['upload_mode'] = mode
+    await update.message.reply_text(f"Please upload the **.xlsx file** for bulk upload (mode: {mode}):", parse_mode='Markdown')
     return ADD_MULTIPLE_FILE
 
 async def add_multiple_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -492,34 +1019,86 @@ async def add_multiple_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Please upload a valid .xlsx file.")
         return ADD_MULTIPLE_FILE
         
-    file = await document.get_file()
-    file_path = f"temp_{document.file_name}"
-    await file.download_to_drive(file_path)
+    trace_id = begin_trace(update.effective_user.id)
+    source, temp_path = await download_document(document, trace_id)
     
     try:
-        with open(file_path, 'rb') as f:
-            files = {'file': (document.file_name, f, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')}
-            res = requests.post(f"{API_BASE_URL}/bulk_upload", files=files)
+        # Chunked and resumable, off the event loop; parsed as soon as the last chunk is in
+        mode = user_data_store.get(update.effective_user.id, {}).get('upload_mode', 'add')
+        with span('api.bulk_upload', trace_id=trace_id):
+            res = await asyncio.to_thread(upload_in_chunks, source, document.file_name, mode,
+                                          api_headers(update.effective_user.id))
             
         if res.status_code == 200:
             data = res.json()
             msg = f"Done!\nAdded: {data['added_count']}\nSkipped: {data['skipped_count']}"
+            if data['mode'] == 'upsert':
+                msg += f"\nUpdated: {data['updated_count']}\nUnchanged: {data['unchanged_count']}"
+            if data['rejected_count']:
+                msg += f"\nRejected: {data['rejected_count']}"
             if data['skipped_duplicates']:
                 msg += f"\nDuplicates: {', '.join(data['skipped_duplicates'][:5])}..."
             await update.message.reply_text(msg)
+            if data.get('error_report_url'):
+                report_url = data['error_report_url'].replace('0.0.0.0', 'localhost')
+                with span('download', trace_id=trace_id):
+                    report_res = await asyncio.to_thread(requests.get, report_url, headers={TRACE_HEADER: trace_id})
+                if report_res.status_code == 200:
+                    await update.message.reply_document(document=report_res.content, filename=os.path.basename(report_url),
+                                                        caption="Rejected rows and the reason for each.")
         else:
             await update.message.reply_text(f"Upload failed: {res.text}")
             
     except Exception as e:
         await update.message.reply_text(f"Error: {e}")
     finally:
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        close_document(source, temp_path)
+        user_data_store.get(update.effective_user.id, {}).pop('upload_mode', None)
             
     return ConversationHandler.END
 
-if __name__ == '__main__':
-    application = ApplicationBuilder().token(TOKEN).build()
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different chats concurrently, but one chat's updates strictly
+    in order, so a conversation never sees its next message before its state is saved.
+    """
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # {chat id: [lock, updates holding or waiting for it]}; dropped once no update needs it
+        self._chat_locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            # Nothing to keep in order (e.g. inline queries)
+            await coroutine
+            return
+        entry = self._chat_locks.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def build_application(token=None):
+    """
+    Builds the bot with all handlers registered.
+    Updates of different chats are processed concurrently (CONCURRENT_UPDATES); TELEGRAM_API_URL
+    redirects Bot API calls.
+    """
+    builder = ApplicationBuilder().token(token or TOKEN).concurrent_updates(ChatOrderedUpdateProcessor(CONCURRENT_UPDATES))
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL.rstrip('/')}/bot").base_file_url(f"{TELEGRAM_API_URL.rstrip('/')}/file/bot")
+    application = builder.build()
     
     # 1. Normal List Processing Handler
     list_conv = ConversationHandler(
@@ -555,6 +1134,12 @@ if __name__ == '__main__':
     application.add_handler(CommandHandler('start', start))
     application.add_handler(CommandHandler('help', help_command))
     application.add_handler(CommandHandler('add_user', add_user_command))
+    application.add_handler(CommandHandler('property', property_command))
+    application.add_handler(CommandHandler('trace', trace_command))
+    application.add_handler(CommandHandler('menus', menus_command))
+    application.add_handler(CommandHandler('export', export_command))
+    application.add_handler(CommandHandler('menu', menu_command))
+    application.add_handler(CommandHandler('allergens', allergens_command))
     
     # Register conversation handlers
     # Order matters? Specific commands usually first.
@@ -564,13 +1149,30 @@ if __name__ == '__main__':
     extract_conv = ConversationHandler(
         entry_points=[CommandHandler("extract_names", extract_command)],
         states={
-            EXTRACT_UPLOAD: [MessageHandler(filters.Document.FileExtension("xlsx"), handle_extract_upload)],
+            EXTRACT_UPLOAD: [MessageHandler(filters.Document.FileExtension("xlsx") | filters.Document.FileExtension("zip"), handle_extract_upload)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
     )
 
     application.add_handler(list_conv)
     application.add_handler(extract_conv) # Catches text, so put last
-    
-    print("Bot is running...")
-    application.run_polling()
+    return application
+
+if __name__ == '__main__':
+    application = build_application()
+    if WEBHOOK_URL:
+        # Without the secret anyone reaching the port could post updates as any (admin) user
+        if not WEBHOOK_SECRET or not re.match(r'^[A-Za-z0-9_-]{1,256}$', WEBHOOK_SECRET):
+            sys.exit("WEBHOOK_SECRET is required in webhook mode (1-256 characters: letters, digits, '_' or '-').")
+        # Telegram pushes updates to the embedded listener instead of us long polling for them
+        print(f"Bot is running (webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH})...")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET
+        )
+    else:
+        print("Bot is running...")
+        application.run_polling()
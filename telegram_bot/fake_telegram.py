@@ -0,0 +1,416 @@
+"""
+Local stand-in for the Telegram Bot API, to run and time the bot's conversation flows offline.
+
+It serves the Bot API methods bot.py uses (getUpdates, setWebhook, sendMessage,
+sendDocument, getFile, file downloads, ...), records what the bot sends, and lets a
+driver play users: the list flow (dish list -> verification -> `ok` -> file) and the
+/add_multiple flow (command -> .xlsx upload -> summary).
+
+    # Spawns the app on a temporary seeded database and bot.py against the fake server
+    python3 telegram_bot/fake_telegram.py --users 4 --rounds 3
+
+    # Same flows with the bot in webhook mode
+    python3 telegram_bot/fake_telegram.py --webhook --users 4
+
+The /add_multiple flow adds dishes, so an app that is already running (--api-url) is
+only used with --allow-writes.
+"""
+import argparse
+import email.parser
+import email.policy
+import io
+import itertools
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+import openpyxl
+import requests
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+from loadtest import build_synthetic_db, percentile, spawn_env, wait_for_server
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Buffet Tags', 'username': 'buffet_tags_bot'}
+XLSX_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+class FakeTelegram:
+    """In-memory Bot API state: pending updates, uploaded files and every message the bot sent."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.files = {}
+        self.sent = []
+        self.webhook = None
+        self.webhook_secret = None
+        # Set once the bot polls for updates or registers its webhook
+        self.ready = threading.Event()
+
+    # --- Driver side (the simulated users) ---
+
+    def _message(self, user_id, **fields):
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}"},
+        }
+        message.update(fields)
+        return message
+
+    def _push(self, message):
+        update = {'update_id': next(self.update_ids), 'message': message}
+        with self.cond:
+            self.updates.append(update)
+            self.cond.notify_all()
+        if self.webhook:
+            headers = {'X-Telegram-Bot-Api-Secret-Token': self.webhook_secret} if self.webhook_secret else {}
+            requests.post(self.webhook, json=update, headers=headers, timeout=10)
+
+    def send_text(self, user_id, text):
+        fields = {'text': text}
+        if text.startswith('/'):
+            fields['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        self._push(self._message(user_id, **fields))
+
+    def send_document(self, user_id, filename, data, mime_type=XLSX_MIME):
+        file_id = uuid.uuid4().hex
+        self.files[file_id] = (filename, data)
+        document = {'file_id': file_id, 'file_unique_id': file_id[:16], 'file_name': filename,
+                    'mime_type': mime_type, 'file_size': len(data)}
+        self._push(self._message(user_id, document=document))
+
+    def mark(self):
+        with self.cond:
+            return len(self.sent)
+
+    def wait_for(self, user_id, predicate, since, timeout=60):
+        """Returns: the first message sent to user_id after index `since` matching predicate, or None."""
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                for msg in self.sent[since:]:
+                    if msg['chat_id'] == user_id and predicate(msg):
+                        return msg
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+    # --- Bot API side ---
+
+    def call(self, method, params):
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            self.ready.set()
+            offset = int(params.get('offset') or 0)
+            deadline = time.time() + float(params.get('timeout') or 0)
+            with self.cond:
+                while True:
+                    # Acknowledged updates (below offset) are dropped, like the real API
+                    self.updates = [u for u in self.updates if u['update_id'] >= offset]
+                    if self.updates or time.time() >= deadline:
+                        return list(self.updates)
+                    self.cond.wait(deadline - time.time())
+        if method == 'setWebhook':
+            self.webhook, self.webhook_secret = params.get('url'), params.get('secret_token')
+            self.ready.set()
+            return True
+        if method == 'deleteWebhook':
+            self.webhook = None
+            return True
+        if method == 'getFile':
+            file_id = params['file_id']
+            filename, data = self.files[file_id]
+            return {'file_id': file_id, 'file_unique_id': file_id[:16], 'file_size': len(data),
+                    'file_path': f"documents/{file_id}/{filename}"}
+        if method in ('sendMessage', 'sendDocument'):
+            chat_id = int(params['chat_id'])
+            record = {'chat_id': chat_id, 'method': method, 'time': time.time(), 'text': params.get('text') or params.get('caption') or ''}
+            reply = {'message_id': next(self.message_ids), 'date': int(time.time()),
+                     'chat': {'id': chat_id, 'type': 'private'}, 'from': BOT_USER, 'text': record['text']}
+            if method == 'sendDocument':
+                filename, size = params.get('document', ('file', b''))[0], len(params.get('document', ('', b''))[1])
+                record['document'] = filename
+                reply['document'] = {'file_id': uuid.uuid4().hex, 'file_unique_id': uuid.uuid4().hex[:16],
+                                     'file_name': filename, 'file_size': size}
+            with self.cond:
+                self.sent.append(record)
+                self.cond.notify_all()
+            return reply
+        # setMyCommands, sendChatAction, ...: accept and ignore
+        return True
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status, body, content_type='application/json'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass # the bot stopped while long polling
+
+        def do_GET(self):
+            # /file/bot<token>/documents/<file_id>/<name>
+            parts = self.path.split('/')
+            if len(parts) > 4 and parts[1] == 'file' and parts[4] in fake.files:
+                self._reply(200, fake.files[parts[4]][1], 'application/octet-stream')
+            else:
+                self._reply(404, b'{}')
+
+        def do_POST(self):
+            # /bot<token>/<method>
+            method = self.path.rstrip('/').rsplit('/', 1)[-1]
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            params = parse_params(self.headers.get('Content-Type', ''), body)
+            try:
+                result = fake.call(method, params)
+                payload = {'ok': True, 'result': result}
+            except Exception as e:
+                payload = {'ok': False, 'error_code': 400, 'description': f"{method}: {e}"}
+            self._reply(200, json.dumps(payload).encode())
+
+    return Handler
+
+
+def parse_params(content_type, body):
+    """Bot API parameters arrive as JSON, a url-encoded form or multipart (uploads); values may be JSON-encoded."""
+    if content_type.startswith('application/json'):
+        return json.loads(body or b'{}')
+    if content_type.startswith('multipart/form-data'):
+        msg = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        params = {}
+        for part in msg.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if part.get_filename():
+                params[name] = (part.get_filename(), part.get_payload(decode=True))
+            else:
+                params[name] = _decode(part.get_payload(decode=True).decode())
+        return params
+    return {k: _decode(v) for k, v in parse_qsl(body.decode())}
+
+
+def _decode(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def serve(port):
+    """Starts the fake Bot API in a background thread. Returns: (FakeTelegram, server)."""
+    fake = FakeTelegram()
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(fake))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return fake, server
+
+
+# --- Scripted conversations ---
+
+def list_flow(fake, user_id, dishes, timeout):
+    """Dish list -> verification list -> `ok` -> generated file. Returns: (ok, seconds, detail)."""
+    start = time.perf_counter()
+    since = fake.mark()
+    fake.send_text(user_id, "\n".join(dishes))
+    reply = fake.wait_for(user_id, lambda m: 'Review Allergens' in m['text'] or 'missing' in m['text'].lower()
+                          or m['text'].startswith('Error'), since, timeout)
+    if not reply or 'Review Allergens' not in reply['text']:
+        return False, time.perf_counter() - start, reply['text'] if reply else 'no verification list'
+
+    since = fake.mark()
+    fake.send_text(user_id, 'ok')
+    reply = fake.wait_for(user_id, lambda m: m['method'] == 'sendDocument' or m['text'].startswith('Error'), since, timeout)
+    ok = bool(reply) and reply['method'] == 'sendDocument'
+    return ok, time.perf_counter() - start, reply['text'] if reply and not ok else 'no file' if not ok else ''
+
+
+def add_multiple_flow(fake, user_id, run_id, timeout):
+    """/add_multiple -> .xlsx upload -> summary. Returns: (ok, seconds, detail)."""
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(['Food Name', 'Calories', 'Allergens'])
+    for i in range(5):
+        ws.append([f"FAKE TG DISH {run_id} {user_id} {i}", 100 + i, 'Milk, Gluten'])
+    buffer = io.BytesIO()
+    wb.save(buffer)
+
+    start = time.perf_counter()
+    since = fake.mark()
+    fake.send_text(user_id, '/add_multiple')
+    if not fake.wait_for(user_id, lambda m: 'upload' in m['text'].lower(), since, timeout):
+        return False, time.perf_counter() - start, 'no upload prompt'
+
+    since = fake.mark()
+    fake.send_document(user_id, 'bulk.xlsx', buffer.getvalue())
+    reply = fake.wait_for(user_id, lambda m: m['text'].startswith(('Done!', 'Upload failed', 'Error'))
+                          and m['method'] == 'sendMessage', since, timeout)
+    ok = bool(reply) and reply['text'].startswith('Done!')
+    return ok, time.perf_counter() - start, '' if ok else (reply['text'] if reply else 'no summary')
+
+
+def wait_for_port(port, timeout=20):
+    """Returns: True once something accepts connections on port (the bot's webhook listener)."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def spawn_app(port, work_dir, dishes):
+    """Starts the app on a seeded database inside work_dir. Returns: (process, api url) or (None, None)."""
+    db_path = os.path.join(work_dir, 'food_database.db')
+    build_synthetic_db(db_path, dishes)
+    env = spawn_env(work_dir, db_path)
+    cmd = [sys.executable, '-m', 'gunicorn', '-w', '2', '--threads', '4', '-b', f"127.0.0.1:{port}", 'app:app']
+    proc = subprocess.Popen(cmd, cwd=ROOT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    if not wait_for_server(base_url):
+        proc.terminate()
+        proc.wait()
+        return None, None
+    return proc, f"{base_url}/api"
+
+
+def start_bot(args, api_port, users, users_file, work_dir):
+    env = dict(os.environ,
+               TRACE_LOG=os.path.join(work_dir, 'trace.log'),
+               TELEGRAM_BOT_TOKEN='123456:FAKE',
+               TELEGRAM_API_URL=f"http://127.0.0.1:{api_port}",
+               API_BASE_URL=args.api_url,
+               ADMIN_USER_ID=str(users[0]),
+               ALLOWED_USERS_FILE=users_file,
+               WEBHOOK_URL=f"http://127.0.0.1:{args.webhook_port}" if args.webhook else '',
+               WEBHOOK_LISTEN='127.0.0.1',
+               WEBHOOK_PORT=str(args.webhook_port),
+               WEBHOOK_SECRET=uuid.uuid4().hex)
+    bot_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+    log = open(args.bot_log, 'w') if args.bot_log else subprocess.DEVNULL
+    return subprocess.Popen([sys.executable, bot_path], env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the bot's conversation flows against a fake Telegram server.")
+    parser.add_argument('--api-url', default='', help="API of a running app (default: spawn one on a temporary database)")
+    parser.add_argument('--allow-writes', action='store_true',
+                        help="Let /add_multiple add test dishes to the --api-url app's catalogue")
+    parser.add_argument('--app-port', type=int, default=5098, help="Port of the spawned app")
+    parser.add_argument('--port', type=int, default=8081, help="Port of the fake Bot API")
+    parser.add_argument('--webhook', action='store_true', help="Run the bot in webhook mode")
+    parser.add_argument('--webhook-port', type=int, default=8444)
+    parser.add_argument('--users', type=int, default=2, help="Simulated users running flows at the same time")
+    parser.add_argument('--rounds', type=int, default=2, help="Flows of each kind per user")
+    parser.add_argument('--dishes', type=int, default=20, help="Dishes per list")
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--bot-log', default='', help="Write the bot's output to this file")
+    args = parser.parse_args()
+
+    if args.api_url and not args.allow_writes:
+        print("The /add_multiple flow adds test dishes to the app's catalogue for good. "
+              "Omit --api-url to use a temporary app, or pass --allow-writes.")
+        return 1
+
+    work_dir = tempfile.mkdtemp(prefix='fake_tg_')
+    app = None
+    server = bot = None
+    try:
+        if not args.api_url:
+            app, args.api_url = spawn_app(args.app_port, work_dir, max(args.dishes, 50))
+            if not app:
+                print("App did not start.")
+                return 1
+
+        # Lists only use dishes the catalogue has, so the flow goes straight to verification
+        res = requests.get(f"{args.api_url}/foods", params={'limit': args.dishes}, timeout=10)
+        dishes = [f['name'] for f in res.json()['items']]
+        if not dishes:
+            print("Catalogue is empty, nothing to send.")
+            return 1
+
+        fake, server = serve(args.port)
+        users = [1000 + i for i in range(args.users)]
+        users_file = os.path.join(work_dir, 'users.json')
+        with open(users_file, 'w') as f:
+            json.dump(users, f)
+
+        bot = start_bot(args, args.port, users, users_file, work_dir)
+        return run_flows(args, fake, users, dishes)
+    finally:
+        if bot:
+            bot.terminate()
+            bot.wait()
+        if server:
+            server.shutdown()
+        if app:
+            app.terminate()
+            app.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_flows(args, fake, users, dishes):
+    """Plays every user's flows at once and prints latencies. Returns: the exit code."""
+    if not fake.ready.wait(30) or (args.webhook and not wait_for_port(args.webhook_port)):
+        print("Bot did not connect to the fake server.")
+        return 1
+
+    run_id = uuid.uuid4().hex[:6]
+    results = {'list': [], 'add_multiple': []}
+    failures = []
+
+    def play(user_id):
+        flows = [('list', lambda: list_flow(fake, user_id, dishes, args.timeout))]
+        if user_id == users[0]:
+            # /add_multiple is admin only; the first user is the admin
+            flows.append(('add_multiple', lambda: add_multiple_flow(fake, user_id, run_id, args.timeout)))
+        for _ in range(args.rounds):
+            for kind, flow in flows:
+                ok, seconds, detail = flow()
+                results[kind].append(seconds)
+                if not ok:
+                    failures.append(f"{kind} (user {user_id}): {detail}")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(users)) as pool:
+        list(pool.map(play, users))
+    elapsed = time.perf_counter() - start
+
+    mode = 'webhook' if args.webhook else 'polling'
+    print(f"\n== {len(users)} users x {args.rounds} rounds, {mode} ({elapsed:.1f}s) ==")
+    print(f"{'flow':<14}{'count':>7}{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}")
+    for kind, values in results.items():
+        values = sorted(values)
+        print(f"{kind:<14}{len(values):>7}{percentile(values, 50) * 1000:>9.0f}"
+              f"{percentile(values, 95) * 1000:>9.0f}{(values[-1] if values else 0) * 1000:>9.0f}")
+    for failure in failures:
+        print(f"FAILED {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,228 @@
+"""
+Lightweight request tracing shared by the bot and the Flask app.
+
+A trace id is minted per bot conversation and sent to the API as the X-Trace-Id
+header. Every hop records timed spans as JSON lines in TRACE_LOG, which can be
+summarised into a waterfall per conversation:
+
+    python3 tracing.py              # waterfall of the latest trace
+    python3 tracing.py <trace_id>   # a specific trace
+    python3 tracing.py --list 20    # latest 20 traces with total time
+    python3 tracing.py --check      # one bot API call against a temporary app: do the spans join up?
+
+The log is rotated to TRACE_LOG.1 once it passes TRACE_LOG_MAX_BYTES, and the bot's
+/trace only reads its last TRACE_READ_BYTES.
+"""
+import asyncio
+import contextvars
+import fcntl
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+TRACE_LOG = os.getenv('TRACE_LOG', os.path.join(os.path.dirname(__file__), 'data', 'trace.log'))
+TRACE_HEADER = 'X-Trace-Id'
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', '1') != '0'
+TRACE_LOG_MAX_BYTES = int(os.getenv('TRACE_LOG_MAX_BYTES', str(5 * 1024 * 1024)))
+TRACE_READ_BYTES = int(os.getenv('TRACE_READ_BYTES', str(1024 * 1024)))
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_service = 'app'
+_write_lock = threading.Lock()
+
+def set_service(name):
+    """Names the process in recorded spans ('app', 'bot', ...)."""
+    global _service
+    _service = name
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+def get_trace_id():
+    return _current_trace.get()
+
+def set_trace_id(trace_id):
+    """Returns: token for reset_trace_id()."""
+    return _current_trace.set(trace_id)
+
+def reset_trace_id(token):
+    _current_trace.reset(token)
+
+def record_span(name, start, duration, trace_id=None, **attrs):
+    """Appends one finished span to the trace log. start is epoch seconds, duration seconds."""
+    trace_id = trace_id or _current_trace.get()
+    if not TRACING_ENABLED or not trace_id:
+        return
+    entry = {
+        'trace_id': trace_id,
+        'service': _service,
+        'name': name,
+        'start': round(start, 6),
+        'duration_ms': round(duration * 1000, 2),
+    }
+    if attrs:
+        entry['attrs'] = attrs
+    line = json.dumps(entry, default=str) + "\n"
+    try:
+        with _write_lock:
+            with open(TRACE_LOG, 'a') as f:
+                # Serialises the rotation with every other process's writes
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.write(line)
+                f.flush()
+                if f.tell() > TRACE_LOG_MAX_BYTES:
+                    os.replace(TRACE_LOG, TRACE_LOG + '.1')
+    except OSError as e:
+        print(f"Trace write error: {e}")
+
+@contextmanager
+def span(name, trace_id=None, **attrs):
+    """
+    Times the enclosed block as a span of trace_id (default: the current trace).
+    Yields the attrs dict so the block can add details (e.g. a status code).
+    """
+    start = time.time()
+    perf_start = time.perf_counter()
+    try:
+        yield attrs
+    except Exception as e:
+        attrs['error'] = str(e)
+        raise
+    finally:
+        record_span(name, start, time.perf_counter() - perf_start, trace_id=trace_id, **attrs)
+
+def read_spans(trace_id=None, path=None, max_bytes=None):
+    """
+    Returns: spans from the log (all, or only trace_id's), oldest first.
+    max_bytes: Only read this much of the end of the log (default TRACE_READ_BYTES, 0 for all).
+    """
+    path = path or TRACE_LOG
+    max_bytes = TRACE_READ_BYTES if max_bytes is None else max_bytes
+    if not os.path.exists(path):
+        return []
+    spans = []
+    with open(path, 'rb') as f:
+        if max_bytes and os.fstat(f.fileno()).st_size > max_bytes:
+            f.seek(-max_bytes, os.SEEK_END)
+            f.readline() # partial line
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if trace_id is None or entry['trace_id'] == trace_id:
+                spans.append(entry)
+    spans.sort(key=lambda s: s['start'])
+    return spans
+
+def list_traces(limit=20, path=None, max_bytes=None):
+    """Returns: latest traces as [(trace_id, first start, total ms, span count)], newest first."""
+    traces = {}
+    for s in read_spans(path=path, max_bytes=max_bytes):
+        first, last, count = traces.get(s['trace_id'], (s['start'], 0, 0))
+        traces[s['trace_id']] = (min(first, s['start']), max(last, s['start'] + s['duration_ms'] / 1000), count + 1)
+    ordered = sorted(traces.items(), key=lambda t: t[1][0], reverse=True)[:limit]
+    return [(tid, first, (last - first) * 1000, count) for tid, (first, last, count) in ordered]
+
+def waterfall(trace_id, path=None, width=40, max_bytes=None):
+    """Returns: a text waterfall of one trace, one line per span."""
+    spans = read_spans(trace_id, path=path, max_bytes=max_bytes)
+    if not spans:
+        return f"No spans for trace {trace_id}."
+
+    t0 = spans[0]['start']
+    total = max(s['start'] + s['duration_ms'] / 1000 for s in spans) - t0
+    scale = width / total if total > 0 else 0
+    lines = [f"Trace {trace_id}: {total * 1000:.0f} ms, {len(spans)} spans"]
+    for s in spans:
+        offset = s['start'] - t0
+        bar_start = int(offset * scale)
+        bar_len = max(1, int(s['duration_ms'] / 1000 * scale))
+        bar = " " * bar_start + "#" * bar_len
+        label = f"{s['service']}:{s['name']}"
+        lines.append(f"{offset * 1000:>7.0f} ms {s['duration_ms']:>8.1f} ms  {bar:<{width + 1}} {label}")
+    return "\n".join(lines)
+
+def check(port=5097):
+    """
+    Starts the app on a temporary database and trace log, and makes one API call through
+    the bot's own helpers inside a bot span. Returns: 0 when the app's span joined the
+    bot's trace, inside the bot span's time window, else 1.
+    """
+    root_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path[:0] = [root_dir, os.path.join(root_dir, 'telegram_bot')]
+    # The bot's spans go through the imported module, not this script's __main__ copy
+    import bot
+    import tracing
+    from loadtest import build_synthetic_db, spawn_env, wait_for_server
+
+    work_dir = tempfile.mkdtemp(prefix='buffet_tracecheck_')
+    tracing.TRACE_LOG = os.path.join(work_dir, 'trace.log')
+    db_path = os.path.join(work_dir, 'food_database.db')
+    names = build_synthetic_db(db_path, 20)
+    env = dict(spawn_env(work_dir, db_path), TRACE_LOG=tracing.TRACE_LOG, TRACING_ENABLED='1')
+    base_url = f"http://127.0.0.1:{port}"
+    app = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-w', '1', '-b', f"127.0.0.1:{port}", 'app:app'],
+                           cwd=root_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_for_server(base_url):
+            print("App did not start.")
+            return 1
+        user_id = 1
+        trace_id = bot.begin_trace(user_id)
+        with tracing.span('api.get_details', trace_id=trace_id):
+            res = asyncio.run(bot.call_api('POST', f"{base_url}/api/get_details", json={'foods': names[:3]},
+                                           headers=bot.api_headers(user_id)))
+        spans = tracing.read_spans(trace_id, max_bytes=0)
+        print(tracing.waterfall(trace_id, max_bytes=0))
+    finally:
+        app.terminate()
+        app.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    bot_spans = [s for s in spans if s['service'] == 'bot']
+    app_spans = [s for s in spans if s['service'] == 'app']
+    problems = []
+    if res.headers.get(TRACE_HEADER) != trace_id:
+        problems.append(f"response carries {TRACE_HEADER} {res.headers.get(TRACE_HEADER)!r}, not {trace_id}")
+    if not bot_spans or not app_spans:
+        problems.append(f"{len(bot_spans)} bot and {len(app_spans)} app spans recorded for the trace")
+    else:
+        outer = bot_spans[0]
+        end = outer['start'] + outer['duration_ms'] / 1000
+        for s in app_spans:
+            # Both processes share this host's clock; allow for rounding only
+            if s['start'] < outer['start'] - 0.001 or s['start'] + s['duration_ms'] / 1000 > end + 0.001:
+                problems.append(f"app span {s['name']} lies outside the bot span")
+    for problem in problems:
+        print(f"FAILED {problem}")
+    if not problems:
+        print("OK: the app's spans joined the bot's trace.")
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args and args[0] == '--check':
+        sys.exit(check())
+    if args and args[0] == '--list':
+        limit = int(args[1]) if len(args) > 1 else 20
+        for tid, first, total_ms, count in list_traces(limit, max_bytes=0):
+            started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(first))
+            print(f"{tid}  {started}  {total_ms:>8.0f} ms  {count} spans")
+    else:
+        if args:
+            trace_id = args[0]
+        else:
+            latest = list_traces(1)
+            if not latest:
+                print("No traces recorded.")
+                sys.exit(0)
+            trace_id = latest[0][0]
+        print(waterfall(trace_id, max_bytes=0))
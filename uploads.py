@@ -0,0 +1,188 @@
+"""
+Chunked, resumable uploads for large catalogue workbooks.
+
+A single multipart POST through the tunnel can time out or be cut off and then has
+to be sent again from byte zero. Instead a client:
+
+    1. POST /api/uploads               {filename, size, sha256}  -> upload_id, offset 0
+    2. PUT  /api/uploads/<id>?offset=N raw chunk bytes           -> new offset
+       (X-Chunk-Sha256 optional; a chunk at the wrong offset gets 409 and the
+        offset to continue from, GET /api/uploads/<id> returns it too)
+    3. POST /api/uploads/<id>/finalize                            -> parsed like /api/bulk_upload
+
+Parts live in UPLOAD_DIR as <id>.part next to <id>.json, so every gunicorn worker
+sees the same upload; appends hold an flock on the part file. Finalizing renames the
+part to <id>.claimed first, so only one request imports it and no chunk lands after
+the checks. Parts idle for longer than UPLOAD_TTL seconds are removed.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+
+UPLOAD_DIR = os.getenv('UPLOAD_DIR', os.path.join(os.path.dirname(__file__), 'data', 'uploads'))
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', str(1024 * 1024)))
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', str(200 * 1024 * 1024)))
+UPLOAD_TTL = int(os.getenv('UPLOAD_TTL', str(24 * 3600)))
+
+_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+class UploadError(Exception):
+    """Raised for a request the upload cannot take. offset is where the client should continue, if known."""
+    def __init__(self, status, message, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+def _paths(upload_id):
+    if not _ID_PATTERN.match(str(upload_id)):
+        raise UploadError(404, "Upload not found.")
+    base = os.path.join(UPLOAD_DIR, upload_id)
+    return base + '.json', base + '.part', base + '.claimed'
+
+def _read_meta(upload_id):
+    meta_path, part_path, claimed_path = _paths(upload_id)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        raise UploadError(404, "Upload not found.")
+    meta['finalizing'] = os.path.exists(claimed_path)
+    data_path = claimed_path if meta['finalizing'] else part_path
+    meta['offset'] = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+    return meta
+
+def cleanup_expired():
+    """Removes uploads with no new chunk for longer than UPLOAD_TTL."""
+    if not os.path.isdir(UPLOAD_DIR):
+        return
+    cutoff = time.time() - UPLOAD_TTL
+    for filename in os.listdir(UPLOAD_DIR):
+        upload_id, ext = os.path.splitext(filename)
+        if ext != '.json' or not _ID_PATTERN.match(upload_id):
+            continue
+        paths = _paths(upload_id)
+        try:
+            # The part file's mtime moves with every appended chunk
+            if max(os.path.getmtime(p) for p in paths if os.path.exists(p)) < cutoff:
+                discard_upload(upload_id)
+        except OSError:
+            pass
+
+def create_upload(filename, size, sha256=None, **meta):
+    """
+    Starts an upload of `size` bytes. sha256: hex digest of the whole file, checked at finalize.
+    meta: extra fields kept with the upload (e.g. mode).
+    Returns: the upload as a dict (upload_id, filename, size, sha256, offset, ...).
+    """
+    if not filename or not str(filename).lower().endswith('.xlsx'):
+        raise UploadError(400, "Invalid file type. Please upload .xlsx")
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise UploadError(400, "Invalid size.")
+    if size <= 0 or size > UPLOAD_MAX_BYTES:
+        raise UploadError(413 if size > 0 else 400, f"File size must be between 1 byte and {UPLOAD_MAX_BYTES} bytes.")
+    if sha256 and not re.match(r'^[0-9a-fA-F]{64}$', str(sha256)):
+        raise UploadError(400, "Invalid sha256.")
+
+    cleanup_expired()
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    upload_id = uuid.uuid4().hex
+    meta_path, part_path, _ = _paths(upload_id)
+    upload = dict(meta, upload_id=upload_id, filename=os.path.basename(str(filename)), size=size,
+                  sha256=sha256.lower() if sha256 else None, created=time.time())
+    with open(meta_path, 'w') as f:
+        json.dump(upload, f)
+    open(part_path, 'wb').close()
+    upload['offset'] = 0
+    return upload
+
+def get_upload(upload_id):
+    """Returns: the upload as a dict with its acknowledged `offset`. Raises: UploadError (404)."""
+    return _read_meta(upload_id)
+
+def append_chunk(upload_id, offset, data, chunk_sha256=None):
+    """
+    Appends data at offset, which must equal the bytes already received.
+    Raises: UploadError (409 with the current offset when offset does not match or the
+            upload is being finalized, 400 for a bad chunk checksum, 413 past the declared size).
+    Returns: the new offset.
+    """
+    meta = _read_meta(upload_id)
+    _, part_path, _ = _paths(upload_id)
+    if chunk_sha256 and hashlib.sha256(data).hexdigest() != chunk_sha256.lower():
+        raise UploadError(400, "Chunk checksum mismatch.", meta['offset'])
+
+    try:
+        fd = os.open(part_path, os.O_WRONLY | os.O_APPEND)
+    except FileNotFoundError:
+        raise UploadError(409, "Upload is being finalized.", meta['offset'])
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        if not _is_current(fd, part_path):
+            # Claimed by finalize_upload while this request waited for the lock
+            raise UploadError(409, "Upload is being finalized.", os.fstat(fd).st_size)
+        current = os.fstat(fd).st_size
+        if offset != current:
+            raise UploadError(409, f"Expected offset {current}.", current)
+        if current + len(data) > meta['size']:
+            raise UploadError(413, "Chunk goes past the declared size.", current)
+        os.write(fd, data)
+        return current + len(data)
+    finally:
+        os.close(fd)
+
+def _is_current(fd, path):
+    """Returns: whether fd is still the file at path (not renamed away since it was opened)."""
+    try:
+        return os.path.samestat(os.fstat(fd), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+def finalize_upload(upload_id):
+    """
+    Claims the assembled file, checks its size and sha256 and hands it over.
+    Only one caller can claim an upload; the others get 409.
+    Returns: (upload dict, path of the complete file). The caller removes the file
+             (discard_upload) once it has been read.
+    """
+    meta = _read_meta(upload_id)
+    _, part_path, claimed_path = _paths(upload_id)
+    if not meta['finalizing'] and meta['offset'] != meta['size']:
+        raise UploadError(409, f"Upload incomplete: {meta['offset']} of {meta['size']} bytes.", meta['offset'])
+    try:
+        # Atomic across workers: whoever renames the part owns the import
+        os.rename(part_path, claimed_path)
+    except FileNotFoundError:
+        raise UploadError(409, "Upload is already being finalized.", meta['offset'])
+    # Fresh mtime, so cleanup_expired leaves the upload alone while it is imported
+    os.utime(claimed_path)
+
+    with open(claimed_path, 'rb') as f:
+        # Waits for an append that opened the part before the rename
+        fcntl.flock(f, fcntl.LOCK_EX)
+        size = os.fstat(f.fileno()).st_size
+        if size != meta['size']:
+            os.rename(claimed_path, part_path)
+            raise UploadError(409, f"Upload incomplete: {size} of {meta['size']} bytes.", size)
+
+        if meta.get('sha256'):
+            digest = hashlib.sha256()
+            for block in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+                digest.update(block)
+            if digest.hexdigest() != meta['sha256']:
+                # Corrupt somewhere, so there is no safe point to resume from
+                discard_upload(upload_id)
+                raise UploadError(422, "File checksum mismatch, please upload again.")
+    meta['offset'] = size
+    meta['finalizing'] = True
+    return meta, claimed_path
+
+def discard_upload(upload_id):
+    for path in _paths(upload_id):
+        if os.path.exists(path):
+            os.remove(path)